@@ -22,14 +22,17 @@ from passlib.apps import custom_app_context as pwd_context
 from tempfile import mkdtemp
 import configparser
 import atexit
+import json
 import os
 from shutil import copyfile
+from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from logger import Logger
+from logger import Logger, invalidate_config
 from helpers import *
 import users
 import metrics
+import sampler
 
 # Aspects of this app setup were borrowed from CS50, including the application and session configuration.
 
@@ -63,43 +66,37 @@ if not os.path.exists(os.path.join(project_path, 'chart_data.db')):
         logger.write('Failed to initialize chart_data.db.')
         exit(1)
 
+# Create chart_data.db tables, or move data from an older layout into them.
+if not init_chart_db():
+    logger.write('Failed to set up chart_data.db tables.')
+    exit(1)
+
 """
     To be ran once, when the webapp is first accessed.
 """
 @app.before_first_request
 def before_first_request():
 
-    # Load record keeping config settings
+    # Load record keeping and report cache config settings
     load_record_conf()
+    load_report_conf()
+
+    # Start keeping report sections warm in memory.
+    sampler.start()
+    atexit.register(sampler.stop)
 
-    # First data point on hours scale. Having this point helps JS build charts in the first hour of running.
-    record_metrics('hours')
+    # First reading. Having this point helps JS build charts in the first hour of running.
+    record_metrics()
 
-    # Schedule recording of metrics for charting.
+    # Schedule recording of metrics for charting. Each reading is rolled into hours, days, and weeks buckets.
     # https://stackoverflow.com/questions/21214270/scheduling-a-function-to-run-every-hour-on-flask
     scheduler = BackgroundScheduler()
     scheduler.start()
-    # Job intervals below may be adjusted to display functionality. However, code assumes the values shown in comments at the end of the lines.
-    scheduler.add_job(
-        func=record_metrics,
-        args=["hours"],
-        trigger=IntervalTrigger(hours=1), # hours=1 (May use other values for testing.)
-        id='hourly_metrics',
-        name='Records current metrics on an hourly scope',
-        replace_existing=True)
-    scheduler.add_job(
-        func=record_metrics,
-        args=["days"],
-        trigger=IntervalTrigger(days=1), # days=1
-        id='daily_metrics',
-        name='Records current metrics on a daily scope',
-        replace_existing=True)
     scheduler.add_job(
         func=record_metrics,
-        args=["weeks"],
-        trigger=IntervalTrigger(weeks=1), # weeks=1
-        id='weekly_metrics',
-        name='Records current metrics on a weekly scope',
+        trigger=IntervalTrigger(minutes=record_settings['sample_minutes']),
+        id='record_metrics',
+        name='Records current metrics into hourly, daily, and weekly buckets',
         replace_existing=True)
     # Shut down the scheduler when exiting the app
     atexit.register(lambda: scheduler.shutdown())
@@ -122,6 +119,8 @@ def cpu():
 
 """
     Displays dmesg logs and, if user is an admin, whm logs (logged by this app).
+    whm logs are returned a page at a time: the last tail lines, or limit lines starting at line offset.
+    Admins can also search whm logs by words in events (q), user, source and a time range (from, to).
 """
 @app.route("/logs")
 @login_required
@@ -132,8 +131,19 @@ def logs():
             logname = request.args.get('logname')
             if not logname:
                 logname = 'whm.log'
+
+            # Return the last tail lines by default, or limit lines from offset. Pages are at most 5000 lines.
+            try:
+                offset = int(request.args.get('offset')) if request.args.get('offset') else None
+                limit = int(request.args.get('limit') or request.args.get('tail') or 500)
+                if not 0 < limit <= 5000 or (offset is not None and offset < 0):
+                    raise ValueError()
+            except ValueError:
+                return jsonify({
+                    'return': 'Failed to read logs...'
+                })
             return jsonify({
-                'return': session['logger'].get_logs(logname)
+                'return': session['logger'].get_logs(logname, offset, limit)
             })
         else:
             # None admin tried to pull whm logs. Deny access and log event.
@@ -143,6 +153,35 @@ def logs():
                     'log_text': 'Access denied...'
                 }
             })
+    elif request.args.get('action') == "search_whm_logs":
+        if not session['admin']:
+            # None admin tried to search whm logs. Deny access and log event.
+            session['logger'].write("Non-admin tried: " + request.args.get('action'))
+            return jsonify({
+                'return': 'Access denied...'
+            })
+
+        # Times may come from datetime-local inputs (YYYY-MM-DDTHH:MM) and are matched as 'YYYY-MM-DD HH:MM:SS'.
+        try:
+            times = []
+            for name in ['from', 'to']:
+                value = (request.args.get(name) or '').replace('T', ' ')
+                if len(value) == 16:
+                    value += ':59' if name == 'to' else ':00'
+                if value:
+                    datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+                times.append(value or None)
+            limit = int(request.args.get('limit') or 200)
+            if not 0 < limit <= 1000:
+                raise ValueError()
+        except ValueError:
+            return jsonify({
+                'return': 'Invalid search.'
+            })
+        return jsonify({
+            'return': session['logger'].search_logs(request.args.get('q') or '', request.args.get('user'),
+                request.args.get('source'), times[0], times[1], limit)
+        })
     else:
         # Webpage requested, return page.
         return render_template("logs.html")
@@ -165,11 +204,31 @@ def network():
 
 """
     Send template to display processes. Additional functionality is provided by JS and other functions.
+    With action get_processes, returns one page of running processes. See get_processes() in helpers.py.
 """
 @app.route("/processes")
 @login_required
 def processes():
-    return render_template("processes.html")
+    if request.args.get('action') == "get_processes":
+        # Sort by CPU% and return the top 100 by default. Pages are at most 1000 processes.
+        # Admins may pass refresh=1 to list processes again instead of paging through the last listing.
+        sort = request.args.get('sort') or 'cpu'
+        try:
+            offset = int(request.args.get('offset') or 0)
+            limit = int(request.args.get('limit') or 100)
+            if sort not in ['pid', 'user', 'ppid', 'state', 'cpu', 'rss', 'time', 'cmd'] or offset < 0 or not 0 < limit <= 1000:
+                raise ValueError()
+        except ValueError:
+            return jsonify({
+                'return': 'Invalid request.'
+            })
+        return jsonify({
+            'return': get_processes(sort, request.args.get('order') != 'asc', request.args.get('q') or '', offset, limit,
+                request.args.get('refresh') == '1' and session['admin'])
+        })
+    else:
+        # Webpage requested, return page.
+        return render_template("processes.html")
 
 """
     Send template for sensors metrics. JS will display info from session storage and from AJAX requests.
@@ -361,6 +420,8 @@ def settings():
                             config.set('logger', var, settings[var])
                     with open('whm.cfg', 'w') as configfile:
                         config.write(configfile)
+                    # Have every Logger pick up the new settings.
+                    invalidate_config()
                 except:
                     return jsonify({
                         'return': False,
@@ -666,14 +727,23 @@ def register():
         return render_template("register.html")
 
 """
-    Returns current metrics report.
+    Returns current metrics report and its age in seconds. Reports are shared between sessions for a short time.
+    Admins may pass force=1 to collect a new report regardless of the cached report's age.
 """
 @app.route("/getReport")
 @login_required
 def getReport():
+    force = request.args.get('force') == '1'
+    if force and not session['admin']:
+        # Non-admin tried to force a new report. Log and serve the cached report.
+        session['logger'].write("Non-admin tried: getReport force")
+        force = False
+
+    result = get_report(session['username'], force)
     return jsonify({
         'reported': True,
-        'report': metrics.main(True, session['username'])
+        'report': result['report'],
+        'age': result['age']
     })
 
 """
@@ -718,7 +788,7 @@ def command():
     session["logger"].write("Running command: " + command)
 
     # Run command and return result.
-    result = metrics.toOS(command)
+    result = metrics.toOS(command, session["logger"])
     if result[1] != 0:
         # Error
         return jsonify({
@@ -734,6 +804,10 @@ def command():
 
 """
     Access data in chart_data where some metrics are recorded over time.
+    History may be limited with from and to (epoch seconds). To poll for new data, pass the cursor from the last
+    response as since. The newest row already held is sent again, since its bucket may have changed.
+    Pass max_points to downsample long histories on the server before they are sent.
+    Pass format=columnar to get history as one list per key instead of rows. See chart_history() in helpers.py.
 """
 @app.route("/chart_data", methods=["POST"])
 @login_required
@@ -742,40 +816,56 @@ def chart_data():
     # Initiate return value.
     result = {}
 
-    # Note the target_table. If no scale is supplied, default to hours.
+    # Note the target data set and scale. If no scale is supplied, default to hours.
     if not request.form.get('scale'):
         scale = 'hours'
     else:
         scale = request.form.get('scale')
-    target_table = request.form.get('data_set') + "_" + scale
+    data_set = request.form.get('data_set')
 
-    # Validate SQL to by seeing if target_table is in the db.
-    tables = [chart[0] for chart in to_sql('SELECT name FROM sqlite_master WHERE type = "table";', "r", "chart_data.db")['details']]
-    if not target_table in tables:
-        session['logger'].write('Failed to read from table. Scope might not be available yet.')
-        session['logger'].write('Table name: ' + target_table)
+    # Note the requested time range, if any.
+    try:
+        start = int(request.form.get('since') or request.form.get('from') or 0)
+        end = int(request.form.get('to')) if request.form.get('to') else None
+    except ValueError:
         return jsonify({
             'success': False,
-            'data': 'Table does not exist.'
+            'data': 'Invalid time range.'
         })
 
-    # If historical data is requested.
-    if request.form.get('data_needed') == 'history':
+    # Note the point limit, if any.
+    try:
+        max_points = int(request.form.get('max_points')) if request.form.get('max_points') else None
+        if max_points is not None and max_points < 3:
+            raise ValueError()
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'data': 'max_points must be a whole number of at least 3.'
+        })
 
-        # Pull table lines based on parameters.
-        lines = to_sql("SELECT * FROM '" + target_table + "';", "r", "chart_data.db")
-        (result['data'], result['success']) = (lines['details'], lines['success'])
+    # Validate the request by seeing if the data set is recorded at this scale.
+    series = chart_series(data_set, scale)
+    if not series:
+        session['logger'].write('Failed to read from table. Scope might not be available yet.')
+        session['logger'].write('Table name: ' + str(data_set) + "_" + scale)
+        return jsonify({
+            'success': False,
+            'data': 'Table does not exist.'
+        })
 
-    # If key keys are needed from DB headers.
+    # If key keys are needed, they are returned in recorded order.
     if request.form.get('data_needed') == 'keys':
-        # Determine key order from DB - SQL validated at start of function.
-        table_layout = to_sql("PRAGMA table_info('" + target_table + "');", "r", "chart_data.db")
-        result['keys'] = []
-        for field in table_layout['details']:
-            # Index 1 stores name of the header
-            if field[1] != 'time':
-                result['keys'].append(field[1])
-        result['success'] = table_layout['success']
+        result['keys'] = [key for (key, series_id) in series]
+
+    # If historical data is requested.
+    try:
+        if request.form.get('data_needed') == 'history':
+            with db_session('chart_data.db') as db:
+                (result['data'], result['cursor']) = chart_history(db, series, start, end, max_points, request.form.get('format') == 'columnar')
+        result['success'] = True
+    except:
+        result['success'] = False
 
     if result['success']:
         # Success, return data.
@@ -787,6 +877,55 @@ def chart_data():
             'data': 'SQL failed to run.'
         })
 
+"""
+    Returns keys and history for several charts at once so a page can load all of its charts in one request.
+    charts is a JSON list of {"data_set": ..., "scale": ...}. max_points is optional, as in chart_data.
+    Each chart's result has its keys and columnar history (see chart_history() in helpers.py) in request order.
+"""
+@app.route("/chart_batch", methods=["POST"])
+@login_required
+def chart_batch():
+    # Load and validate requested charts.
+    try:
+        charts = json.loads(request.form.get('charts'))
+        if not isinstance(charts, list) or len(charts) > 100:
+            raise ValueError()
+        max_points = int(request.form.get('max_points')) if request.form.get('max_points') else None
+        if max_points is not None and max_points < 3:
+            raise ValueError()
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'data': 'Invalid chart list.'
+        })
+
+    # Read every chart in one database session.
+    result = []
+    try:
+        with db_session('chart_data.db') as db:
+            for chart in charts:
+                scale = chart.get('scale') or 'hours'
+                series = chart_series(chart.get('data_set'), scale)
+                (data, cursor) = chart_history(db, series, 0, None, max_points, True)
+                result.append({
+                    'data_set': chart.get('data_set'),
+                    'scale': scale,
+                    'success': len(series) > 0,
+                    'keys': [key for (key, series_id) in series],
+                    'data': data,
+                    'cursor': cursor
+                })
+    except:
+        return jsonify({
+            'success': False,
+            'data': 'SQL failed to run.'
+        })
+
+    return jsonify({
+        'success': True,
+        'charts': result
+    })
+
 if __name__ == '__main__':
     port_n = get_config('whm.cfg')['port_n']
     app.run(host="0.0.0.0", port=port_n)
\ No newline at end of file
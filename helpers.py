@@ -7,14 +7,87 @@
 
 from flask import redirect, render_template, request, session
 from functools import wraps
+from contextlib import contextmanager
 from time import strftime
-from datetime import datetime, timedelta
+from datetime import datetime
+import calendar
+import os
+import time
+import threading
 import sqlite3
 import configparser
 import metrics
+import sampler
 
 # Global variable to track record config vars.
 record_age_limits = {}
+record_settings = {
+    'sample_minutes': 5
+}
+
+# Process-wide cache of the last full metrics report, shared by all sessions. See get_report().
+report_cache = {
+    'report': None,
+    'time': 0,
+    'ttl': 30,
+    'collecting': False,
+    'generation': 0
+}
+report_cache_cond = threading.Condition()
+
+# Last process listing, shared by all sessions so every page of a listing comes from the same snapshot and CPU% is
+# measured over at least ttl seconds. See get_processes().
+process_cache = {
+    'processes': None,
+    'time': 0,
+    'ttl': 5
+}
+process_cache_lock = threading.Lock()
+
+# chart_data.db layout. Each series is one key of one data set at one scope, e.g. ('cpu', 'hours', 'idle').
+# samples is clustered on (series_id, time), so range reads and retention deletes for a series are index seeks
+# and the value is read from the same b-tree. Recording a new metric only adds rows to series.
+# Since version 2, each sample is a bucket starting at time that summarizes every reading taken during it:
+# value is the average, along with min, max and the count of readings.
+chart_schema = [
+    """CREATE TABLE IF NOT EXISTS series (
+        series_id INTEGER PRIMARY KEY,
+        data_set TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        UNIQUE (data_set, scope, key)
+    )""",
+    """CREATE TABLE IF NOT EXISTS samples (
+        series_id INTEGER NOT NULL,
+        time INTEGER NOT NULL,
+        value NUMERIC,
+        PRIMARY KEY (series_id, time)
+    ) WITHOUT ROWID"""
+]
+chart_schema_version = 2
+
+# Length of each scope's buckets in seconds, and the offset that starts weeks on Monday (epoch 0 is a Thursday).
+bucket_seconds = {
+    'hours': 3600,
+    'days': 86400,
+    'weeks': 604800
+}
+bucket_offset = {
+    'hours': 0,
+    'days': 0,
+    'weeks': 345600
+}
+
+# In-memory copy of the series table as {(data_set, scope): [(key, series_id)]} in column order. Loaded by
+# init_chart_db() and extended by record_metrics() as it adds series, so lookups never query the database.
+series_catalog = {}
+series_catalog_lock = threading.Lock()
+
+# Idle SQLite connections kept open for reuse, by database path. See db_session().
+db_pool = {}
+db_pool_lock = threading.Lock()
+db_pool_max = 8
 
 """
     Decorate routes to require login.
@@ -81,15 +154,101 @@ def get_config(file):
     return result
 
 """
-    Run partial metrics report and update chart_data with timestamped data.
-    Accepted "hours", "days", or "weeks" as scope.
+    Returns {'report': full metrics report, 'age': seconds since it was collected}.
+    The background sampler's snapshot is used while every section has been sampled recently. Otherwise a cached
+    report is returned while it is younger than report_ttl in whm.cfg. Only one collection runs at a time; callers
+    that arrive during a collection wait for its result instead of starting their own.
+    force skips the snapshot and the age check but still shares a collection already in progress.
+"""
+def get_report(user, force=False):
+    # Use the sampler's snapshot when it is warm.
+    if not force:
+        sampled = sampler.get(metrics.partial_sections + metrics.full_sections)
+        if sampled is not None:
+            return sampled
+
+    with report_cache_cond:
+        if report_cache['collecting']:
+            # Wait for the collection in progress to finish and use its result.
+            generation = report_cache['generation']
+            while report_cache['collecting'] and report_cache['generation'] == generation:
+                report_cache_cond.wait()
+            if report_cache['report'] is not None:
+                return {
+                    'report': report_cache['report'],
+                    'age': round(time.time() - report_cache['time'], 1)
+                }
+        elif not force and report_cache['report'] is not None and time.time() - report_cache['time'] < report_cache['ttl']:
+            # Cached report is fresh enough.
+            return {
+                'report': report_cache['report'],
+                'age': round(time.time() - report_cache['time'], 1)
+            }
+
+        # This caller collects the report.
+        report_cache['collecting'] = True
+
+    # Collect outside of the lock so waiting callers are not blocked from checking in.
+    report = None
+    try:
+        report = metrics.main(True, user)
+    finally:
+        # Publish the result (if any) and wake waiting callers.
+        with report_cache_cond:
+            if report is not None:
+                report_cache['report'] = report
+                report_cache['time'] = time.time()
+            report_cache['collecting'] = False
+            report_cache['generation'] += 1
+            report_cache_cond.notify_all()
+
+    return {
+        'report': report,
+        'age': 0.0
+    }
+
+"""
+    Returns {'processes': one page of running processes, 'total': number of processes matching query, 'offset'}.
+    Processes are sorted by sort (any key of metrics.listProcesses(), highest first if descending) and kept if query
+    is part of their pid, user, or command. Takes offset and limit to page through the sorted list.
+    Pages are taken from the last listing while it is younger than process_cache['ttl'], unless refresh is True.
 """
-def record_metrics(scope):
-    # Partial report stored in update.
-    update = metrics.main(False, 'metrics-tracker')
+def get_processes(sort='cpu', descending=True, query='', offset=0, limit=100, refresh=False):
+    with process_cache_lock:
+        if refresh or process_cache['processes'] is None or time.time() - process_cache['time'] >= process_cache['ttl']:
+            process_cache['processes'] = metrics.listProcesses()
+            process_cache['time'] = time.time()
+        processes = process_cache['processes'][:]
 
-    # Load a list of present charts in DB.
-    charts = [chart[0] for chart in to_sql('SELECT name FROM sqlite_master WHERE type = "table";', "r", "chart_data.db")['details']]
+    # Filter, then sort with pid breaking ties so pages stay stable between requests.
+    if query:
+        query = query.lower()
+        processes = [process for process in processes
+            if query in str(process['pid']) or query in process['user'].lower() or query in process['cmd'].lower()]
+    # CPU time is H:MM:SS, with any number of hours, so it is compared as numbers.
+    processes.sort(key=lambda process: process['pid'])
+    if sort == 'time':
+        processes.sort(key=lambda process: [int(part) for part in process['time'].split(':')], reverse=descending)
+    else:
+        processes.sort(key=lambda process: process[sort], reverse=descending)
+
+    return {
+        'processes': processes[offset:offset + limit],
+        'total': len(processes),
+        'offset': offset
+    }
+
+"""
+    Run partial metrics report once and roll it into the current hours, days, and weeks buckets in chart_data.
+    Each bucket keeps the min, max, average, and count of every reading taken during its interval.
+"""
+def record_metrics():
+    # Partial report stored in update. Taken from the sampler's snapshot when it is warm.
+    sampled = sampler.get(metrics.partial_sections)
+    if sampled is not None:
+        update = sampled['report']
+    else:
+        update = metrics.main(False, 'metrics-tracker')
 
     # Used to convert hours, days, and weeks to hours.
     hours_to_other = {
@@ -98,71 +257,255 @@ def record_metrics(scope):
         'weeks': 168
     }
 
-    """
-        Write data to DB. table_prefix and scope determine which table.
-        table_prefix should look like "section_optionalSubSection_". Ex. "cpu_" or " mem_Swap_".
-        table_prefix and data are both strings (data is CSV).
-    """
-    def record(table_prefix, data, keys):
-        # Determine table to write to.
-        table = table_prefix + "_" + scope
-
-        # If table doesn't exist it is created.
-        if not table in charts:
-            # Build table creation command and then run it.
-            create_table = "CREATE TABLE '" + table + "' ('time' DATETIME"
-            for key in keys:
-                create_table += ", '" + key + "' NUMERIC"
-            create_table += ")"
-            to_sql(create_table, 'w', 'chart_data.db')
-
-        # Insert data into table.
-        to_sql("INSERT INTO '" + table + "' VALUES (CURRENT_TIMESTAMP" + data + ");" , 'w', 'chart_data.db')
-
-        # Clean old entries
-        oldest_time = datetime.now() - timedelta(hours = int(record_age_limits[scope]) * hours_to_other[scope])
-        oldest_time_str = oldest_time.strftime('%Y-%m-%d %H:%M:%S')
-        to_sql('DELETE from "' + table + '" where time < strftime("%Y-%m-%d %H:%M:%S", "' + oldest_time_str + '")', 'w', 'chart_data.db')
+    # Values for this tick by data set. Each is (list of keys, list of values) and all are written together below.
+    rows = {}
 
     """
-        Prepares data (a dictionary) to be entered into an SQL command.
-        Returns (String of CSV as entered in SQL, List of keys to correspond with the CSV).
+        Queue data for the DB. data_set should look like "section_optionalSubSection". Ex. "cpu" or "mem_Swap".
+        data is a dictionary of keys and their numeric string values. Values that are not numbers are skipped.
     """
-    def dict_to_sql_part(data):
-        # Initiate return values.
-        sql_part = ""
+    def record(data_set, data):
         keys = []
-
-        # Iterate through data building return values.
+        values = []
         for key in data:
-            sql_part += ', ' + data[key]
-            keys.append(key)
+            try:
+                values.append(float(data[key]))
+                keys.append(key)
+            except ValueError:
+                continue
+        rows[data_set] = (keys, values)
 
-        # Return items ready for SQL entry.
-        return (sql_part, keys)
-
-    # Proccess and record info for each monitored section.
+    # Proccess and queue info for each monitored section.
 
     # Sensors section.
-    for device in update["sensors"]:
-        (sens_update, keys) = dict_to_sql_part(update['sensors'][device]['values'])
-        record('sens_' + update["sensors"][device]["name0"], sens_update, keys)
+    for device in update.get("sensors", {}):
+        record('sens_' + update["sensors"][device]["name0"], update['sensors'][device]['values'])
 
     # Mem section.
-    for mem_group in update["memory"]:
-        (mem_update, keys) = dict_to_sql_part(update['memory'][mem_group])
-        record('mem_' + mem_group , mem_update, keys)
+    for mem_group in update.get("memory", {}):
+        record('mem_' + mem_group, update['memory'][mem_group])
 
     # CPU section.
-    (cpu_update, keys) = dict_to_sql_part(update['cpu'])
-    record('cpu', cpu_update, keys)
+    if 'cpu' in update:
+        record('cpu', update['cpu'])
 
     # Storage section.
     processed_sto = {}
-    for ld in update['logical_volumes']:
+    for ld in update.get('logical_volumes', []):
         processed_sto[ld['mount_point'].replace('/', '_')] = ld['use_percent'][:-1]
-    (sto_update, keys) = dict_to_sql_part(processed_sto)
-    record('sto', sto_update, keys)
+    record('sto', processed_sto)
+
+    # Write the whole tick in one transaction so it costs one commit no matter how many series are written.
+    now = int(time.time())
+    added = []
+    try:
+        with db_session('chart_data.db') as db:
+            for scope in ['hours', 'days', 'weeks']:
+                # Start of the bucket this tick falls in, and the start of the oldest bucket to keep.
+                bucket = now - (now - bucket_offset[scope]) % bucket_seconds[scope]
+                oldest_time = now - int(record_age_limits[scope]) * hours_to_other[scope] * 3600
+
+                # Look up series ids for this scope, adding series seen for the first time after the data set's other keys.
+                series = {}
+                next_position = {}
+                with series_catalog_lock:
+                    for (data_set, series_scope) in series_catalog:
+                        if series_scope == scope:
+                            for (key, series_id) in series_catalog[(data_set, scope)]:
+                                series[(data_set, key)] = series_id
+                            next_position[data_set] = len(series_catalog[(data_set, scope)])
+                samples = []
+                for data_set in rows:
+                    (keys, values) = rows[data_set]
+                    for i in range(len(keys)):
+                        if not (data_set, keys[i]) in series:
+                            position = next_position.get(data_set, 0)
+                            crsr = db.execute('INSERT INTO series (data_set, scope, key, position) VALUES (?, ?, ?, ?)', (data_set, scope, keys[i], position))
+                            series[(data_set, keys[i])] = crsr.lastrowid
+                            next_position[data_set] = position + 1
+                            added.append((data_set, scope, keys[i], crsr.lastrowid))
+                        samples.append((series[(data_set, keys[i])], bucket, values[i]))
+
+                # Start any new buckets empty, then fold this reading into each bucket's aggregates.
+                db.executemany('INSERT OR IGNORE INTO samples (series_id, time, value, min, max, count) VALUES (?, ?, ?, ?, ?, 0)',
+                    [(series_id, bucket_time, value, value, value) for (series_id, bucket_time, value) in samples])
+                db.executemany('UPDATE samples SET value = (value * count + ?) / (count + 1), min = min(min, ?), max = max(max, ?), count = count + 1 WHERE series_id = ? AND time = ?',
+                    [(value, value, value, series_id, bucket_time) for (series_id, bucket_time, value) in samples])
+
+                # Clean old buckets for every series at this scope.
+                db.executemany('DELETE FROM samples WHERE series_id = ? AND time < ?', [(series_id, oldest_time) for series_id in series.values()])
+    except:
+        # Error occured - Nothing from this tick was written.
+        return {
+            'success': False,
+            'details': "Failed to record metrics."
+        }
+
+    # Series are only added to the catalog once their rows are committed.
+    with series_catalog_lock:
+        for (data_set, scope, key, series_id) in added:
+            series_catalog.setdefault((data_set, scope), []).append((key, series_id))
+
+    return {
+        'success': True,
+        'details': 'Write Complete'
+    }
+
+"""
+    Creates the chart_data.db tables if needed and moves data from the older layout, where each data set and
+    scope had its own table (ex. 'cpu_hours'), into them. Tracks progress with PRAGMA user_version.
+    Returns True on success.
+"""
+def init_chart_db():
+    try:
+        with db_session('chart_data.db') as db:
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            if version >= chart_schema_version:
+                load_series_catalog(db)
+                return True
+
+            # Version 1: series and samples tables.
+            if version < 1:
+                for command in chart_schema:
+                    db.execute(command)
+
+                # Move each old table's rows into series and samples, then drop it.
+                tables = [table[0] for table in db.execute('SELECT name FROM sqlite_master WHERE type = "table"')]
+                for table in tables:
+                    (data_set, sep, scope) = table.rpartition('_')
+                    if not scope in ['hours', 'days', 'weeks']:
+                        continue
+                    keys = [field[1] for field in db.execute("PRAGMA table_info('" + table + "')")][1:]
+                    series_ids = []
+                    for position in range(len(keys)):
+                        db.execute('INSERT OR IGNORE INTO series (data_set, scope, key, position) VALUES (?, ?, ?, ?)', (data_set, scope, keys[position], position))
+                        series_ids.append(db.execute('SELECT series_id FROM series WHERE data_set = ? AND scope = ? AND key = ?', (data_set, scope, keys[position])).fetchone()[0])
+                    samples = []
+                    for line in db.execute("SELECT * FROM '" + table + "'"):
+                        # Old times are CURRENT_TIMESTAMP strings in UTC.
+                        line_time = calendar.timegm(datetime.strptime(line[0], '%Y-%m-%d %H:%M:%S').timetuple())
+                        for i in range(len(series_ids)):
+                            samples.append((series_ids[i], line_time, line[i + 1]))
+                    db.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?)', samples)
+                    db.execute("DROP TABLE '" + table + "'")
+
+            # Version 2: bucket aggregates. Existing samples are moved to the start of their scope's bucket, and
+            # samples that land in the same bucket are merged into one.
+            if version < 2:
+                db.execute('ALTER TABLE samples ADD COLUMN min NUMERIC')
+                db.execute('ALTER TABLE samples ADD COLUMN max NUMERIC')
+                db.execute('ALTER TABLE samples ADD COLUMN count INTEGER NOT NULL DEFAULT 1')
+                for scope in ['hours', 'days', 'weeks']:
+                    buckets = db.execute('SELECT series_id, time - (time - ?) % ? AS bucket, AVG(value), MIN(value), MAX(value), COUNT(*) FROM samples WHERE series_id IN (SELECT series_id FROM series WHERE scope = ?) GROUP BY series_id, bucket',
+                        (bucket_offset[scope], bucket_seconds[scope], scope)).fetchall()
+                    db.execute('DELETE FROM samples WHERE series_id IN (SELECT series_id FROM series WHERE scope = ?)', (scope,))
+                    db.executemany('INSERT INTO samples (series_id, time, value, min, max, count) VALUES (?, ?, ?, ?, ?, ?)', buckets)
+
+            db.execute('PRAGMA user_version = ' + str(chart_schema_version))
+            load_series_catalog(db)
+        return True
+    except:
+        return False
+
+"""
+    Replaces series_catalog with the contents of the series table. db is an open chart_data.db connection.
+"""
+def load_series_catalog(db):
+    catalog = {}
+    for (data_set, scope, key, series_id) in db.execute('SELECT data_set, scope, key, series_id FROM series ORDER BY position'):
+        catalog.setdefault((data_set, scope), []).append((key, series_id))
+    with series_catalog_lock:
+        series_catalog.clear()
+        series_catalog.update(catalog)
+
+"""
+    Returns [(key, series_id)] in column order for a data set at a scope. The list is empty if it is not recorded.
+    Served from series_catalog, so no database access is needed.
+"""
+def chart_series(data_set, scope):
+    with series_catalog_lock:
+        return list(series_catalog.get((data_set, scope), []))
+
+"""
+    Returns (data, cursor) for series, a list of (key, series_id) as returned by chart_series().
+    By default data is rows of [time, value for each series], oldest first, with times formatted as
+    'YYYY-MM-DD HH:MM:SS' in UTC. If columnar is True, data is {'time_start': epoch seconds of the oldest row,
+    'time_deltas': seconds from the previous row (0 for the first), 'columns': {key: values}} instead.
+    Missing values are None.
+    Optionally, limit rows to start <= time <= end in epoch seconds. cursor is the epoch time of the newest row, or
+    start if there are no rows. Passing it back as start returns that row (its bucket may still be filling) and newer ones.
+    If max_points is given, rows are downsampled so each series contributes at most max_points / len(series) points.
+"""
+def chart_history(db, series, start=0, end=None, max_points=None, columnar=False):
+    if end is None:
+        end = int(time.time())
+
+    # Read each series with an index range scan and pivot values into one row per time.
+    lines = {}
+    for i in range(len(series)):
+        for (line_time, value) in db.execute('SELECT time, value FROM samples WHERE series_id = ? AND time >= ? AND time <= ? ORDER BY time', (series[i][1], start, end)):
+            if not line_time in lines:
+                lines[line_time] = [line_time] + [None] * len(series)
+            lines[line_time][i + 1] = value
+    times = sorted(lines)
+    cursor = times[-1] if times else start
+
+    # Keep the rows LTTB picks for any series. The newest row is always kept so polling can resume from it.
+    if max_points is not None and len(times) > max_points:
+        threshold = max(3, max_points // max(1, len(series)))
+        keep = set([len(times) - 1])
+        for i in range(1, len(series) + 1):
+            points = [(n, lines[times[n]][i]) for n in range(len(times)) if lines[times[n]][i] is not None]
+            keep.update(points[n][0] for n in lttb([(times[x], y) for (x, y) in points], threshold))
+        times = [times[n] for n in sorted(keep)]
+
+    # One list per key, with times as deltas which are short and repetitive.
+    if columnar:
+        return ({
+            'time_start': times[0] if times else start,
+            'time_deltas': [0] + [times[n] - times[n - 1] for n in range(1, len(times))] if times else [],
+            'columns': {series[i][0]: [lines[line_time][i + 1] for line_time in times] for i in range(len(series))}
+        }, cursor)
+
+    # Format times for charting.
+    rows = []
+    for line_time in times:
+        rows.append([datetime.utcfromtimestamp(line_time).strftime('%Y-%m-%d %H:%M:%S')] + lines[line_time][1:])
+    return (rows, cursor)
+
+"""
+    Largest-Triangle-Three-Buckets downsampling.
+    Takes a list of (x, y) points sorted by x and returns the indexes of at most threshold points that keep the shape
+    of the line. The first and last points are always kept.
+    https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+"""
+def lttb(points, threshold):
+    count = len(points)
+    if threshold >= count or threshold < 3:
+        return list(range(count))
+
+    # Points between the first and last are split into threshold - 2 buckets. One point is picked from each.
+    indexes = [0]
+    bucket_size = (count - 2) / (threshold - 2)
+    a = 0
+    for bucket in range(threshold - 2):
+        # Average of the next bucket, which the triangle's third corner uses.
+        next_start = int((bucket + 1) * bucket_size) + 1
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        avg_x = sum(points[n][0] for n in range(next_start, next_end)) / (next_end - next_start)
+        avg_y = sum(points[n][1] for n in range(next_start, next_end)) / (next_end - next_start)
+
+        # Pick the point in this bucket that makes the largest triangle with the last pick and the next bucket's average.
+        (ax, ay) = points[a]
+        largest = -1
+        for n in range(int(bucket * bucket_size) + 1, next_start):
+            area = abs((ax - avg_x) * (points[n][1] - ay) - (ax - points[n][0]) * (avg_y - ay))
+            if area > largest:
+                largest = area
+                a = n
+        indexes.append(a)
+    indexes.append(count - 1)
+    return indexes
 
 """
     Ensures strings are save for SQL entry.
@@ -182,32 +525,26 @@ def validate_sql(s):
     command is a script of SQL to run.
     mode is a script, "w" to write, and "r" to read.
     db is a string to specify the filename of the db.
+    params optionally supplies values for ? placeholders in command.
 """
-def to_sql(command, mode, db):
+def to_sql(command, mode, db, params=()):
     try:
-        # Set up db and cursor.
-        db = sqlite3.connect(db)
-        crsr = db.cursor()
-
-        # Run command.
-        crsr.execute(command)
+        with db_session(db) as conn:
+            # Run command.
+            crsr = conn.execute(command, params)
 
-        # If writing, commit change and return success.
-        if mode == 'w':
-            db.commit()
-            db.close()
-            return {
-                'success': True,
-                'details': 'Write Complete'
-            }
-        # If reading, return data.
-        elif mode == 'r':
-            result = crsr.fetchall()
-            db.close()
-            return {
-                'success': True,
-                'details': result
-            }
+            # If writing, return success. Change is committed when the session closes.
+            if mode == 'w':
+                return {
+                    'success': True,
+                    'details': 'Write Complete'
+                }
+            # If reading, return data.
+            elif mode == 'r':
+                return {
+                    'success': True,
+                    'details': crsr.fetchall()
+                }
         # Neither reading or writing.
         return {
                 'success': False,
@@ -220,6 +557,46 @@ def to_sql(command, mode, db):
             'details': "SQL failed: " + command
         }
 
+"""
+    Opens a connection to db set up for concurrent use. WAL lets readers continue while a write is in progress,
+    and the busy timeout makes a second writer wait instead of failing with "database is locked".
+"""
+def db_connect(db):
+    conn = sqlite3.connect(db, timeout=10, check_same_thread=False, cached_statements=256)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-8000')
+    return conn
+
+"""
+    Borrows a pooled connection to db for use in a with statement. The connection is used by one thread at a time.
+    Everything run in the session is committed when it ends, or rolled back if an exception was raised.
+"""
+@contextmanager
+def db_session(db):
+    # Reuse an idle connection if there is one.
+    db = os.path.abspath(db)
+    with db_pool_lock:
+        idle = db_pool.setdefault(db, [])
+        conn = idle.pop() if idle else None
+    if conn is None:
+        conn = db_connect(db)
+
+    try:
+        yield conn
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        # Return the connection to the pool, or close it if enough are idle already.
+        with db_pool_lock:
+            if len(db_pool[db]) < db_pool_max:
+                db_pool[db].append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
 """
     Loads current record config settings into record_age_limits.
 """
@@ -230,4 +607,23 @@ def load_record_conf():
         'hours': config['hours_age_max'],
         'days': config['days_age_max'],
         'weeks': config['weeks_age_max'],
-    }
\ No newline at end of file
+    }
+
+    # Minutes between readings rolled into the buckets. Older configs may not have this setting.
+    try:
+        config = configparser.RawConfigParser()
+        config.read('whm.cfg')
+        record_settings['sample_minutes'] = max(1, config.getint('record', 'sample_minutes'))
+    except:
+        pass
+
+"""
+    Loads the report cache TTL from whm.cfg. The default is kept if the setting is missing.
+"""
+def load_report_conf():
+    try:
+        config = configparser.RawConfigParser()
+        config.read('whm.cfg')
+        report_cache['ttl'] = config.getint('metrics', 'report_ttl')
+    except:
+        pass
\ No newline at end of file
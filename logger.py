@@ -3,84 +3,191 @@
     This class allows each user and source to have their own instance in order
     to maintain accountability and to track down errors. File management is taken care of
     here so that over files simply need to create an instance and pass in events to log.
+    Events are queued and written to whm.log in batches by a single background thread that keeps the file open,
+    so logging an event does not cost any file system calls.
+    The same thread keeps a full-text search index of whm.log and its archives in logs/whm_search.db.
+    Archives are gzip compressed when they are made and are decompressed as they are read.
 """
 
 import datetime
 import os
-import shutil
 import configparser
+import queue
+import threading
+import atexit
+import time
+import sqlite3
+import gzip
+import shutil
+import collections
 
-class Logger():
+# Events waiting for the writer thread. Each is (Logger, line, mode, force) as passed to Logger.write(),
+# a threading.Event to set once everything queued before it is written, a function for the writer to run,
+# or None to stop. See writer().
+log_queue = queue.Queue()
+writer_threads = []
+writer_lock = threading.Lock()
 
-    """
-        Construct this Logger.
-        Takes the acting user and the source tool or file generating the event. Both are strings.
-    """
-    def __init__(self, user, source):
+# Archives waiting to be compressed by the compressor thread, as (log directory, archive name, Logger or None).
+# Compressing runs beside the writer so a large archive does not hold up logging. See compressor().
+compress_queue = queue.Queue()
+compressor_threads = []
 
-        # Load globals from whm.cfg.
-        config_success = True
-        global max_log_size
-        global max_log_age
-        try:
-            config = configparser.RawConfigParser()
-            config.read('whm.cfg')
-            max_log_size = config.getint('logger', 'max_log_size')
-            max_log_age = datetime.timedelta(**{config.get('logger', 'max_log_age_unit'): config.getint('logger', 'max_log_age_n')})
+# Queued events are written once this many bytes are waiting or the oldest has waited this many seconds.
+flush_bytes = 65536
+flush_seconds = 0.5
 
-            user_str_len = config.getint('logger', 'user_str_len')
-            source_str_len = config.getint('logger', 'source_str_len')
+# Archived logs as (time archived, filename), oldest first. Read from the log directory when the writer starts and
+# kept current by rotate(), so pruning never has to scan the directory. See load_archives().
+archives = []
+archives_lock = threading.Lock()
 
-        except:
-            # Failed to read config, setting default values.
-            max_log_size = 145000
-            max_log_age = datetime.timedelta(hours=1)
+# Sparse line index of each log that has been read, as {logname: {'inode', 'size': bytes indexed, 'lines': lines
+# indexed, 'offsets': byte offset of every index_step-th line}}. Lets get_logs() seek to a line. See update_line_index().
+line_index = {}
+line_index_lock = threading.Lock()
+index_step = 1000
+
+# Full-text search index of every log line, kept by the writer thread. 'db' is its connection, or None if the index
+# could not be opened (e.g. SQLite without FTS5), in which case logging carries on without it. See index_log().
+# Event text is not stored: lines_fts is contentless and results are read from the logs, where each event starts
+# event_at characters into its line. Ids are never reused, so entries that could not be removed from lines_fts
+# (their log was gone) never match a new line.
+search_index = {'db': None}
+search_schema_version = 1
+search_schema = [
+    """CREATE TABLE IF NOT EXISTS lines (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        logname TEXT NOT NULL,
+        line INTEGER NOT NULL,
+        time TEXT NOT NULL,
+        source TEXT NOT NULL,
+        user TEXT NOT NULL,
+        event_at INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS lines_logname ON lines (logname, line)",
+    "CREATE INDEX IF NOT EXISTS lines_time ON lines (time)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5(event, content='')",
+    """CREATE TABLE IF NOT EXISTS indexed_logs (
+        logname TEXT PRIMARY KEY,
+        inode INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        lines INTEGER NOT NULL
+    )"""
+]
+
+# Event levels, least to most severe. Events below the level set in whm.cfg are not logged.
+levels = {
+    'debug': 10,
+    'info': 20,
+    'warn': 30,
+    'error': 40
+}
 
-            user_str_len = 15
-            source_str_len = 12
+# Last time each (user, source, event) was logged and how many repeats were skipped since. See check_repeat().
+# Only debug events and events from routine sources are skipped. Other events, such as user actions from WebApp,
+# are always logged.
+recent_events = {}
+repeat_sources = ['metrics.py', 'sampler.py', 'logger.py']
+recent_events_lock = threading.Lock()
+recent_events_max = 1000
 
-            config_success = False
+# Settings from the [logger] section of whm.cfg, shared by every Logger. See load_config().
+log_config = {
+    'max_log_size': 145000,
+    'max_log_age': datetime.timedelta(hours=1),
+    'user_str_len': 15,
+    'source_str_len': 12,
+    'level': 'info',
+    'repeat_seconds': 0,
+    'mtime': None,
+    'checked': 0
+}
+log_config_lock = threading.Lock()
 
-        # Load other instance variables.
-        self.user = (user + (" " * user_str_len))[:user_str_len]
-        self.source = (source + (" " * source_str_len))[:source_str_len]
+# Seconds between checks of whm.cfg's modification time.
+config_check_seconds = 5
+
+class Logger():
+
+    """
+        Construct this Logger.
+        Takes the acting user and the source tool or file generating the event. Both are strings.
+    """
+    def __init__(self, user, source):
+        # Load instance variables.
+        self.user = user
+        self.source = source
         self.path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "logs")
 
         # Logger to track actions from logger.py.
         if source != "logger.py":
             self.selfLogger = Logger(user, "logger.py")
-            if not config_success:
-                self.selfLogger.write("Failed to load vars from config.")
 
-        # If ./logs dir doesn't exist, it is created.
-        if not os.path.exists(self.path):
-            os.makedirs(self.path)
+        # Make sure settings from whm.cfg are current. They are only read again if the file has changed.
+        if not load_config() and source != "logger.py":
+            self.selfLogger.write("Failed to load vars from config.")
+
+        start_writer()
 
     """
         Add event to whm.log.
         eventin is the string describing the event.
         mode specifies the method of writing. "a" to append and "w" to overwrite.
         force allows writing regardless of current log size.
+        level is one of levels. Appended events below the configured level are dropped. Repeats of a debug event, or of
+        an event from one of repeat_sources, by the same user within repeat_seconds are dropped too. The next time it
+        is logged, the number of skipped repeats is noted.
+        The event is queued and written by the writer thread. Call flush() to wait for it to reach the file.
+    """
+    def write(self, eventin, mode="a", force=False, level="info"):
+        if mode == "a" and not force:
+            if levels.get(level, levels['info']) < levels.get(log_config['level'], levels['info']):
+                return 0
+            if level == 'debug' or self.source in repeat_sources:
+                repeats = check_repeat(self.user, self.source, eventin)
+                if repeats is None:
+                    return 0
+                if repeats:
+                    eventin += " (repeated " + str(repeats) + " more times)"
+        log_queue.put((self, self.line(eventin), mode, force))
+        return 0
+
+    """
+        Add a debug event to whm.log. Used for routine details that are only needed when troubleshooting.
+    """
+    def debug(self, eventin):
+        return self.write(eventin, level="debug")
+
     """
-    def write(self, eventin, mode="a", force=False):
-        # Ensure log is within configured size limits.
-        if not force and os.path.isfile(os.path.join(self.path, "whm.log")):
-            self.checkSize()
+        Add an info event to whm.log.
+    """
+    def info(self, eventin):
+        return self.write(eventin, level="info")
+
+    """
+        Add a warn event to whm.log. Used when something went wrong but was handled.
+    """
+    def warn(self, eventin):
+        return self.write(eventin, level="warn")
+
+    """
+        Add an error event to whm.log. Used when something failed.
+    """
+    def error(self, eventin):
+        return self.write(eventin, level="error")
 
+    """
+        Returns eventin formatted as a line of whm.log, stamped with the current time.
+    """
+    def line(self, eventin):
         # Removes newline chars from log entries and get current time.
         event = eventin.replace("\n", "{NL}")
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        user = (self.user + (" " * log_config['user_str_len']))[:log_config['user_str_len']]
+        source = (self.source + (" " * log_config['source_str_len']))[:log_config['source_str_len']]
+        return timestamp + ' ' + source + ' ' + user + ' ' + event + '\n'
 
-        # Attempt write file operation.
-        try:
-            log = open(os.path.join(self.path, "whm.log"), mode)
-            log.write(timestamp + ' ' + self.source + ' ' +self.user + ' ' + event + '\n')
-            log.close()
-            return 0
-        except:
-            # Failed - Return.
-            print("Error: Failed to write to log.")
-            return 1
     """
         Start a new empty log.
     """
@@ -88,89 +195,698 @@ class Logger():
         return self.selfLogger.write('Log cleared', 'w', True)
 
     """
-        Copy whm.log to a backup named with date and time.
-        Pass name if filename was tried and already exists.
+        Return a page of lines from the active log by default as well as the available logs.
+        Optionally, provide a logname to read an archived log instead.
+        By default the last limit lines are returned. Pass offset to get limit lines starting at that line instead.
+        Only the requested lines are read, so the size of the log does not matter.
     """
-    def backup(self, name=None):
-        # Ensure whm.log existes.
-        if not os.path.isfile(os.path.join(self.path, "whm.log")):
-            return 1
+    def get_logs(self, logname='whm.log', offset=None, limit=500):
+        # Make sure queued events are in the file before reading it.
+        flush()
 
-        # Determine new filename and its path.
-        if name == None:
-            bak_name = 'whm_bak_' + datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S') + '.log'
-            bak_path = os.path.join(self.path, bak_name)
-        else:
-            # Tack an 'a' to the end of the filename and try again.
-            bak_name = name[:-4] + 'a.log'
-            bak_path = os.path.join(self.path, bak_name)
-
-        # Ensure backup name doesn't already exist.
-        # This may occure if this function is called more than once in the same second.
-        if os.path.isfile(bak_path):
-            # Try again with an 'a' appended to file name.
-            return self.backup(bak_name)
+        # Only whm.log and archives in the index can be read. They are listed newest first.
+        with archives_lock:
+            files = ['whm.log'] + [filename for (archive_time, filename) in reversed(archives)]
+        if not logname in files:
+            return 'Failed to read logs...'
 
-        # Attempt file operation to copy the current log to the new file.
+        # Try file operations to read the requested lines.
         try:
-            shutil.copy(os.path.join(self.path, 'whm.log'), bak_path)
-            self.selfLogger.write('whm.log backed up to ' + bak_name)
-            return 0
+            path = os.path.join(self.path, logname)
+            index = update_line_index(path, logname, files)
+            if offset is None:
+                lines = tail_lines(path, index['size'], limit)
+                offset = index['lines'] - len(lines)
+            else:
+                offset = max(0, min(offset, index['lines']))
+                lines = read_lines(path, index, offset, limit)
+            return {
+                'log_text': ''.join(lines),
+                'log_files': files,
+                'offset': offset,
+                'total_lines': index['lines']
+            }
         except:
-            return 3
+            return 'Failed to read logs...'
+
     """
-        Return all text in the active log by default as well as the available logs.
-        Optionally, provide a logname to get its text.
+        Search whm.log and its archives. Returns up to limit matching lines, newest first, as dicts with the
+        time, source, user and event of the line along with the logname and line number it is at.
+        query is words to find in events; a word ending in * matches as a prefix. Each other argument is optional:
+        exact user and source to match, and start and end times as 'YYYY-MM-DD HH:MM:SS'.
     """
-    def get_logs(self, logname='whm.log'):
-        # Try file operation to read log and OS operation to list the log directory contents.
+    def search_logs(self, query='', user=None, source=None, start=None, end=None, limit=200):
+        # Make sure queued events are indexed before searching.
+        flush()
+
+        # Build the query from the filters given.
+        sql = 'SELECT lines.time, lines.source, lines.user, lines.logname, lines.line, lines.event_at FROM lines'
+        conditions = []
+        params = []
+        terms = []
+        for word in query.split():
+            prefix = word.endswith('*')
+            word = word.rstrip('*')
+            if word:
+                terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+        if terms:
+            sql += ' JOIN lines_fts ON lines_fts.rowid = lines.id'
+            conditions.append('lines_fts MATCH ?')
+            params.append(' '.join(terms))
+        for (column, operator, value) in [('user', '=', user), ('source', '=', source), ('time', '>=', start), ('time', '<=', end)]:
+            if value:
+                conditions.append('lines.' + column + ' ' + operator + ' ?')
+                params.append(value)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY lines.time DESC, lines.id DESC LIMIT ?'
+        params.append(limit)
+
+        # Try to run the search.
         try:
-            log = open(os.path.join(self.path, logname))
-            log_text = log.read()
-            log.close()
-            files = sorted(os.listdir(self.path), reverse=True)
-            files.insert(0, files.pop())
-            return {
-                'log_text': log_text,
-                'log_files': files
+            db = sqlite3.connect(os.path.join(self.path, 'whm_search.db'), timeout=10)
+            try:
+                rows = db.execute(sql, params).fetchall()
+            finally:
+                db.close()
+        except:
+            return 'Failed to search logs...'
+
+        # Read the events of matching lines from the logs, one pass through each log.
+        with archives_lock:
+            files = ['whm.log'] + [filename for (archive_time, filename) in reversed(archives)]
+        events = {}
+        for logname in set(row[3] for row in rows):
+            try:
+                path = os.path.join(self.path, logname)
+                text = read_line_numbers(path, update_line_index(path, logname, files), [row[4] for row in rows if row[3] == logname])
+            except:
+                text = {}
+            for row in rows:
+                if row[3] == logname:
+                    events[(logname, row[4])] = text.get(row[4], '')[row[5]:].rstrip('\n')
+        return [{
+            'time': row[0],
+            'source': row[1],
+            'user': row[2],
+            'event': events[(row[3], row[4])],
+            'logname': row[3],
+            'line': row[4]
+        } for row in rows]
+
+"""
+    Brings the line index of logname at path up to date and returns a copy of it. Only bytes of whm.log added since
+    the last call are scanned, and archives are only scanned once. whm.log's index starts over if the file was
+    replaced, as it is when it is rotated. files is the list of readable logs. Indexes of logs no longer in it are dropped.
+    Byte offsets are into the decompressed text of compressed archives.
+"""
+def update_line_index(path, logname, files):
+    with line_index_lock:
+        for name in list(line_index):
+            if not name in files:
+                del line_index[name]
+        index = line_index.get(logname)
+        if index is not None and logname != 'whm.log':
+            return dict(index, offsets=list(index['offsets']))
+        stat = os.stat(path)
+        if index is None or index['inode'] != stat.st_ino or index['size'] > stat.st_size:
+            index = {'inode': stat.st_ino, 'size': 0, 'lines': 0, 'offsets': [0]}
+            line_index[logname] = index
+
+        # Count complete lines after what is already indexed, noting where every index_step-th line starts.
+        # Reading only moves forward so compressed archives are decompressed once.
+        with open_log(path) as log:
+            log.seek(index['size'])
+            position = index['size']
+            rest = b''
+            while True:
+                chunk = log.read(65536)
+                if not chunk:
+                    break
+                chunk = rest + chunk
+                last = chunk.rfind(b'\n')
+                rest = chunk[last + 1:]
+                chunk = chunk[:last + 1]
+                if index['lines'] + chunk.count(b'\n') < len(index['offsets']) * index_step:
+                    # No indexed line starts in this chunk.
+                    index['lines'] += chunk.count(b'\n')
+                else:
+                    end = chunk.find(b'\n')
+                    while end != -1:
+                        index['lines'] += 1
+                        if index['lines'] % index_step == 0:
+                            index['offsets'].append(position + end + 1)
+                        end = chunk.find(b'\n', end + 1)
+                position += len(chunk)
+            index['size'] = position
+        return dict(index, offsets=list(index['offsets']))
+
+"""
+    Returns up to count lines of the log at path starting at line number start, using its line index to seek close
+    to it first. Lines past the indexed part of the file are not read.
+"""
+def read_lines(path, index, start, count):
+    lines = []
+    with open_log(path) as log:
+        log.seek(index['offsets'][start // index_step])
+        for i in range(start % index_step):
+            log.readline()
+        while len(lines) < count and log.tell() < index['size']:
+            lines.append(log.readline().decode(errors='replace'))
+    return lines
+
+"""
+    Returns {line number: line} for the line numbers given, reading the log at path once from the index offset
+    before the first of them. Lines past the indexed part of the file are not read.
+"""
+def read_line_numbers(path, index, numbers):
+    lines = {}
+    if not numbers:
+        return lines
+    wanted = set(numbers)
+    line = min(wanted) - min(wanted) % index_step
+    with open_log(path) as log:
+        log.seek(index['offsets'][line // index_step])
+        while line <= max(wanted) and log.tell() < index['size']:
+            text = log.readline()
+            if line in wanted:
+                lines[line] = text.decode(errors='replace')
+            line += 1
+    return lines
+
+"""
+    Returns the last count lines before byte end of the log at path. Plain logs are read backwards from end in
+    blocks. Compressed archives cannot seek backwards cheaply, so they are streamed keeping only the last count lines.
+"""
+def tail_lines(path, end, count):
+    if count <= 0:
+        return []
+    if path.endswith('.gz'):
+        with open_log(path) as log:
+            lines = collections.deque(maxlen=count)
+            position = 0
+            for line in log:
+                position += len(line)
+                if position > end:
+                    break
+                lines.append(line.decode(errors='replace'))
+        return list(lines)
+
+    buffer = b''
+    position = end
+    with open(path, 'rb') as log:
+        # Read blocks until there are enough newlines to be sure of the first line's start.
+        while position > 0 and buffer.count(b'\n') <= count:
+            size = min(65536, position)
+            position -= size
+            log.seek(position)
+            buffer = log.read(size) + buffer
+    lines = buffer.split(b'\n')[:-1]
+    if position > 0:
+        lines = lines[1:]
+    return [line.decode(errors='replace') + '\n' for line in lines[-count:]]
+
+"""
+    Opens the log at path for reading bytes, decompressing it as it is read if it is a compressed archive.
+"""
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+"""
+    Loads log settings from whm.cfg into log_config if they were never loaded, were invalidated, or the file's
+    modification time has changed. The modification time is checked at most every config_check_seconds.
+    Returns False if whm.cfg was read just now and failed, in which case defaults are used.
+"""
+def load_config():
+    with log_config_lock:
+        now = time.time()
+        if log_config['checked'] and now - log_config['checked'] < config_check_seconds:
+            return True
+        log_config['checked'] = now
+        try:
+            mtime = os.path.getmtime('whm.cfg')
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime == log_config['mtime']:
+            return True
+        log_config['mtime'] = mtime
+
+        try:
+            config = configparser.RawConfigParser()
+            config.read('whm.cfg')
+            settings = {
+                'max_log_size': config.getint('logger', 'max_log_size'),
+                'max_log_age': datetime.timedelta(**{config.get('logger', 'max_log_age_unit'): config.getint('logger', 'max_log_age_n')}),
+                'user_str_len': config.getint('logger', 'user_str_len'),
+                'source_str_len': config.getint('logger', 'source_str_len'),
+                'level': config.get('logger', 'level', fallback='info'),
+                'repeat_seconds': config.getint('logger', 'repeat_seconds', fallback=0)
             }
+            if not settings['level'] in levels:
+                raise ValueError()
         except:
-            return 'Failed to read logs...'
+            # Failed to read config, setting default values.
+            settings = {
+                'max_log_size': 145000,
+                'max_log_age': datetime.timedelta(hours=1),
+                'user_str_len': 15,
+                'source_str_len': 12,
+                'level': 'info',
+                'repeat_seconds': 0
+            }
+            log_config.update(settings)
+            return False
+        log_config.update(settings)
+        return True
 
-    """
-        Backs up and clears old logs as configured to ensure smooth file operations.
-    """
-    def checkSize(self):
-        # Return if whm.log does not need maintenance.
-        if os.path.getsize(os.path.join(self.path, "whm.log")) < max_log_size:
-            return 0
-
-        # whm.log is too large - backs it up and clears it.
-        self.selfLogger.write("Max log size reached: " + str(max_log_size) + " - Started new log.", "a", True)
-        self.backup()
-        self.clear()
-        self.selfLogger.write("Max log size reached: " + str(max_log_size) + " - Started new log.")
-
-        # A new back up was create - Ensures all backups are within age limit.
-        now = datetime.datetime.now()
-        for filename in os.listdir(self.path):
-            # Parse established time from filename in format YYYYMMDDHHMMSS
-            filetimestr = ""
-            for c in filename:
-                if 48 <= ord(c) <= 57:
-                    filetimestr += c
-
-            # Ensure non-empty string. Current logfile will be skipped here.
-            if filetimestr != "":
-                try:
-                    # Will pass if numbers are in the correct date format.
-                    filetimeobj = datetime.datetime.strptime(filetimestr, '%Y%m%d%H%M%S')
-                except:
-                    # There is a file with numbers in the name but they do not translate to a date - loop next filename
-                    self.selfLogger.write("Unexpected item found in log directory: " + filename)
-                    continue
-
-                # If file is too old, it is deleted.
-                if now - max_log_age > filetimeobj:
-                    os.remove(os.path.join(self.path, filename))
-                    self.selfLogger.write("Deleted aged log: " + filename)
+"""
+    Notes that event is being logged by user from source. Returns None if the same event from the same user and source
+    was logged less than repeat_seconds ago, in which case it should be skipped. Otherwise returns how many repeats were skipped
+    since it was last logged. Always returns 0 if repeat_seconds is 0.
+"""
+def check_repeat(user, source, event):
+    window = log_config['repeat_seconds']
+    if window <= 0:
+        return 0
+    now = time.time()
+    with recent_events_lock:
+        seen = recent_events.get((user, source, event))
+        if seen is not None and now - seen[0] < window:
+            seen[1] += 1
+            return None
+
+        # Forget events that are past the window before adding another.
+        if len(recent_events) >= recent_events_max:
+            for key in [key for key in recent_events if now - recent_events[key][0] >= window]:
+                del recent_events[key]
+            if len(recent_events) >= recent_events_max:
+                recent_events.clear()
+        recent_events[(user, source, event)] = [now, 0]
+        return seen[1] if seen is not None else 0
+
+"""
+    Makes the next load_config() read whm.cfg again. Call after writing the [logger] section.
+"""
+def invalidate_config():
+    with log_config_lock:
+        log_config['checked'] = 0
+        log_config['mtime'] = None
+
+"""
+    Starts the writer thread if it is not running. Queued events are written at exit.
+"""
+def start_writer():
+    with writer_lock:
+        if writer_threads:
+            return
+
+        # If ./logs dir doesn't exist, it is created.
+        path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "logs")
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        thread = threading.Thread(target=writer, name="log-writer", daemon=True)
+        thread.start()
+        writer_threads.append(thread)
+        atexit.register(stop_writer)
+
+        # The compressor keeps running once started. Archives it did not finish are compressed again on the next start.
+        if not compressor_threads:
+            thread = threading.Thread(target=compressor, name="log-compressor", daemon=True)
+            thread.start()
+            compressor_threads.append(thread)
+
+"""
+    Writes everything queued so far and stops the writer thread. Waits at most timeout seconds for it to finish.
+"""
+def stop_writer(timeout=5):
+    with writer_lock:
+        if not writer_threads:
+            return
+        log_queue.put(None)
+        writer_threads.pop().join(timeout)
+
+"""
+    Blocks until events queued before this call are in whm.log, or timeout seconds pass.
+"""
+def flush(timeout=5):
+    done = threading.Event()
+    log_queue.put(done)
+    return done.wait(timeout)
+
+"""
+    Thread target. Collects queued events into batches and writes each batch with one buffered write to
+    whm.log, which is kept open between batches. The size of whm.log is counted as lines are written.
+"""
+def writer():
+    path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "logs", "whm.log")
+    load_archives(os.path.dirname(path))
+    open_search_index(os.path.dirname(path))
+
+    # Compress archives left uncompressed, as when the application stopped while compressing.
+    with archives_lock:
+        for (archive_time, filename) in archives:
+            if not filename.endswith('.gz'):
+                compress_queue.put((os.path.dirname(path), filename, None))
+    log = None
+    size = 0
+    while True:
+        # Wait for an event, then gather more until enough bytes are waiting, flush_seconds pass or flush() is called.
+        batch = [log_queue.get()]
+        waiting = 0
+        deadline = time.time() + flush_seconds
+        while isinstance(batch[-1], tuple) and waiting < flush_bytes:
+            try:
+                batch.append(log_queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+            if isinstance(batch[-1], tuple):
+                waiting += len(batch[-1][1])
+
+        # Set aside flush() events, the stop request and functions to run so a failed write cannot lose them.
+        tasks = [event for event in batch if callable(event)]
+        done = [event for event in batch if not isinstance(event, tuple) and not callable(event)]
+        batch = [event for event in batch if isinstance(event, tuple)]
+
+        # Attempt write file operations.
+        try:
+            if log is None:
+                log = open(path, "a")
+                size = log.tell()
+            for (logger, line, mode, force) in batch:
+                if mode == "w":
+                    # Start the file over.
+                    log.close()
+                    drop_indexed('whm.log', path)
+                    log = open(path, "w")
+                    size = 0
+                elif not force and size >= log_config['max_log_size']:
+                    # Ensure log is within configured size limits.
+                    (log, size) = rotate(log, path, logger)
+                log.write(line)
+                size += len(line.encode())
+            log.flush()
+
+            # Add the new lines to the search index.
+            index_log('whm.log', path)
+
+            # Run work handed to the writer by other threads, such as finishing a compressed archive.
+            for task in tasks:
+                task()
+        except:
+            # Failed - Drop this batch and reopen the file for the next one.
+            print("Error: Failed to write to log.")
+            try:
+                log.close()
+            except:
+                pass
+            log = None
+        finally:
+            # Wake callers waiting on flush().
+            for event in done:
+                if event is not None:
+                    event.set()
+
+        # Stop if asked to.
+        if None in done:
+            if log is not None:
+                log.close()
+            if search_index['db'] is not None:
+                search_index['db'].close()
+                search_index['db'] = None
+            return
+
+"""
+    Moves a full log to a backup and starts a new one, then deletes backups older than max_log_age.
+    Runs on the writer thread. Takes the open log, its path and the Logger whose event filled it.
+    Returns (new open log, its size in bytes).
+"""
+def rotate(log, path, logger):
+    self_logger = getattr(logger, 'selfLogger', logger)
+    log_dir = os.path.dirname(path)
+    now = datetime.datetime.now()
+
+    # whm.log is too large - renames it to a backup, which does not copy any data, and starts a new one.
+    log.write(self_logger.line("Max log size reached: " + str(log_config['max_log_size']) + " - Started new log."))
+    log.close()
+    index_log('whm.log', path)
+    events = ['Log cleared', "Max log size reached: " + str(log_config['max_log_size']) + " - Started new log."]
+    bak_name = backup_name(log_dir, now)
+    try:
+        os.rename(path, os.path.join(log_dir, bak_name))
+        with archives_lock:
+            archives.append((now, bak_name))
+        rename_indexed('whm.log', bak_name)
+        events.append('whm.log backed up to ' + bak_name)
+    except OSError:
+        events.append('Failed to back up whm.log.')
+        bak_name = None
+    log = open(path, "w")
+
+    # Compress the new backup on the compressor thread.
+    if bak_name is not None:
+        compress_queue.put((log_dir, bak_name, self_logger))
+
+    # A new back up was created - Deletes backups past the age limit, which are at the front of the index.
+    with archives_lock:
+        while archives and archives[0][0] < now - log_config['max_log_age']:
+            filename = archives.pop(0)[1]
+            try:
+                drop_indexed(filename, os.path.join(log_dir, filename))
+                os.remove(os.path.join(log_dir, filename))
+                events.append("Deleted aged log: " + filename)
+            except OSError:
+                events.append("Failed to delete aged log: " + filename)
+
+    text = ''.join(self_logger.line(event) for event in events)
+    log.write(text)
+    return (log, len(text.encode()))
+
+"""
+    Thread target. Compresses archives from compress_queue to a gzip copy named with '.gz.part' added, then hands the
+    copy to the writer thread to finish with finish_compress(). Takes as long as it needs without holding up logging.
+"""
+def compressor():
+    while True:
+        (log_dir, bak_name, logger) = compress_queue.get()
+        path = os.path.join(log_dir, bak_name)
+        try:
+            with open(path, 'rb') as archive, gzip.open(path + '.gz.part', 'wb', compresslevel=6) as compressed:
+                shutil.copyfileobj(archive, compressed, 1048576)
+        except:
+            # The uncompressed archive is kept. It may also have been deleted for its age while waiting.
+            try:
+                os.remove(path + '.gz.part')
+            except OSError:
+                pass
+            if logger is not None and os.path.exists(path):
+                logger.write('Failed to compress ' + bak_name)
+        else:
+            log_queue.put(lambda: finish_compress(log_dir, bak_name, logger))
+
+"""
+    Runs on the writer thread once compressor() has made a compressed copy of the archive bak_name in log_dir.
+    Puts the copy in place as bak_name + '.gz', updates the archive and search indexes, and removes the uncompressed
+    archive. Readers with the uncompressed archive open can finish reading it. The copy is dropped if the archive was
+    deleted for its age in the meantime.
+"""
+def finish_compress(log_dir, bak_name, logger=None):
+    path = os.path.join(log_dir, bak_name)
+    try:
+        with archives_lock:
+            archived = [i for i in range(len(archives)) if archives[i][1] == bak_name]
+            if not archived:
+                os.remove(path + '.gz.part')
+                return
+            os.rename(path + '.gz.part', path + '.gz')
+            archives[archived[0]] = (archives[archived[0]][0], bak_name + '.gz')
+        rename_indexed(bak_name, bak_name + '.gz', os.stat(path + '.gz').st_ino)
+        os.remove(path)
+    except OSError:
+        if logger is not None:
+            logger.write('Failed to compress ' + bak_name)
+        return
+    if logger is not None:
+        logger.write('Compressed ' + bak_name)
+
+"""
+    Opens the search index in log_dir and indexes whatever whm.log and the archives have that it does not.
+    Runs on the writer thread, which then owns the connection. The index is turned off if it cannot be opened.
+"""
+def open_search_index(log_dir):
+    try:
+        db = sqlite3.connect(os.path.join(log_dir, 'whm_search.db'), timeout=10)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        if db.execute('PRAGMA user_version').fetchone()[0] < search_schema_version:
+            # Older indexes stored every event. Start over, and give the space back.
+            for table in ['lines_fts', 'lines', 'indexed_logs']:
+                db.execute('DROP TABLE IF EXISTS ' + table)
+            db.commit()
+            db.execute('VACUUM')
+        for command in search_schema:
+            db.execute(command)
+        db.execute('PRAGMA user_version = ' + str(search_schema_version))
+        db.commit()
+    except:
+        print("Error: Failed to open log search index. Searching logs is unavailable.")
+        return
+    search_index['db'] = db
+
+    # Forget archives that were deleted, then catch up on all logs.
+    with archives_lock:
+        files = ['whm.log'] + [filename for (archive_time, filename) in archives]
+    for (logname,) in db.execute('SELECT logname FROM indexed_logs').fetchall():
+        if not logname in files:
+            drop_indexed(logname)
+    for logname in files:
+        index_log(logname, os.path.join(log_dir, logname))
+
+"""
+    Adds lines of the log at path that are not in the search index yet. Lines are split into fields by the widths
+    in log_config. whm.log is indexed from the start again if it was replaced or shrank. Archives are indexed once.
+"""
+def index_log(logname, path):
+    db = search_index['db']
+    if db is None:
+        return
+    try:
+        stat = os.stat(path)
+    except OSError:
+        # Nothing has been logged yet.
+        return
+    try:
+        row = db.execute('SELECT inode, size, lines FROM indexed_logs WHERE logname = ?', (logname,)).fetchone()
+        if row is not None and logname != 'whm.log' and row[0] == stat.st_ino:
+            # Archives do not change once indexed.
+            return
+        if row is None or row[0] != stat.st_ino or (logname == 'whm.log' and row[1] > stat.st_size):
+            unindex_lines(db, logname, path)
+            row = (stat.st_ino, 0, 0)
+        (size, line) = row[1:]
+
+        # Read complete lines added since the last call and split them into fields.
+        source_len = log_config['source_str_len']
+        user_len = log_config['user_str_len']
+        with open_log(path) as log:
+            log.seek(size)
+            text = log.read()
+        text = text[:text.rfind(b'\n') + 1]
+        event_at = 22 + source_len + user_len
+        sequence = db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'lines'").fetchone()
+        line_id = sequence[0] if sequence is not None else 0
+        lines = []
+        events = []
+        for text_line in [part.decode(errors='replace') for part in text.split(b'\n')[:-1]]:
+            line_id += 1
+            lines.append((line_id, logname, line, text_line[:19], text_line[20:20 + source_len].strip(),
+                text_line[21 + source_len:21 + source_len + user_len].strip(), event_at))
+            events.append((line_id, text_line[event_at:]))
+            line += 1
+
+        db.executemany('INSERT INTO lines (id, logname, line, time, source, user, event_at) VALUES (?, ?, ?, ?, ?, ?, ?)', lines)
+        db.executemany('INSERT INTO lines_fts (rowid, event) VALUES (?, ?)', events)
+        db.execute('INSERT OR REPLACE INTO indexed_logs (logname, inode, size, lines) VALUES (?, ?, ?, ?)',
+            (logname, stat.st_ino, size + len(text), line))
+        db.commit()
+    except:
+        db.rollback()
+        print("Error: Failed to index log: " + logname)
+
+"""
+    Moves search index entries from one logname to another, as when whm.log is renamed to an archive.
+    Pass inode if the log was replaced by a new file with the same lines, as when an archive is compressed.
+"""
+def rename_indexed(logname, new_logname, inode=None):
+    db = search_index['db']
+    if db is None:
+        return
+    try:
+        db.execute('UPDATE lines SET logname = ? WHERE logname = ?', (new_logname, logname))
+        db.execute('UPDATE indexed_logs SET logname = ? WHERE logname = ?', (new_logname, logname))
+        if inode is not None:
+            db.execute('UPDATE indexed_logs SET inode = ? WHERE logname = ?', (inode, new_logname))
+        db.commit()
+    except:
+        db.rollback()
+        print("Error: Failed to rename indexed log: " + logname)
+
+"""
+    Removes a log from the search index, as when it is cleared or deleted. Pass the log's path while it still exists
+    so its events can be removed from lines_fts too. See unindex_lines().
+"""
+def drop_indexed(logname, path=None):
+    db = search_index['db']
+    if db is None:
+        return
+    try:
+        unindex_lines(db, logname, path)
+        db.execute('DELETE FROM indexed_logs WHERE logname = ?', (logname,))
+        db.commit()
+    except:
+        db.rollback()
+        print("Error: Failed to drop indexed log: " + logname)
+
+"""
+    Deletes the indexed lines of logname without committing. A contentless index can only forget an event given its
+    exact text, so events are removed from lines_fts only if path is still the file that was indexed. Otherwise they
+    are left behind, unreachable, since their lines are gone.
+"""
+def unindex_lines(db, logname, path=None):
+    row = db.execute('SELECT inode, size FROM indexed_logs WHERE logname = ?', (logname,)).fetchone()
+    try:
+        stat = os.stat(path) if path is not None else None
+    except OSError:
+        stat = None
+    if row is not None and stat is not None and stat.st_ino == row[0] and (logname != 'whm.log' or stat.st_size >= row[1]):
+        with open_log(path) as log:
+            text = [part.decode(errors='replace') for part in log.read(row[1]).split(b'\n')[:-1]]
+        events = []
+        for (line_id, line, event_at) in db.execute('SELECT id, line, event_at FROM lines WHERE logname = ?', (logname,)):
+            if line < len(text):
+                events.append((line_id, text[line][event_at:]))
+        db.executemany("INSERT INTO lines_fts (lines_fts, rowid, event) VALUES ('delete', ?, ?)", events)
+    db.execute('DELETE FROM lines WHERE logname = ?', (logname,))
+
+"""
+    Fills the archive index from the backups in log_dir. Their times are parsed from names made by backup_name().
+"""
+def load_archives(log_dir):
+    found = []
+    for filename in os.listdir(log_dir):
+        if not filename.startswith('whm_bak_'):
+            continue
+        if filename.endswith('.part'):
+            # Unfinished compressed copy. Its archive is compressed again.
+            try:
+                os.remove(os.path.join(log_dir, filename))
+            except OSError:
+                pass
+            continue
+        try:
+            found.append((datetime.datetime.strptime(filename[8:27], '%Y_%m_%d_%H_%M_%S'), filename))
+        except ValueError:
+            continue
+
+    # Backups from the same second are ordered by how many a's were tacked onto their names.
+    found.sort(key=lambda archive: (archive[0], len(archive[1].replace('.gz', '')), archive[1]))
+    with archives_lock:
+        archives[:] = found
+
+"""
+    Returns an unused name for a backup of whm.log in log_dir, named with the date and time now.
+"""
+def backup_name(log_dir, now):
+    bak_name = 'whm_bak_' + now.strftime('%Y_%m_%d_%H_%M_%S') + '.log'
+
+    # Ensure backup name doesn't already exist.
+    # This may occure if this function is called more than once in the same second.
+    with archives_lock:
+        names = set(filename for (archive_time, filename) in archives)
+    # Its compressed name is checked as well.
+    while any(name in names or os.path.isfile(os.path.join(log_dir, name)) for name in [bak_name, bak_name + '.gz']):
+        # Tack an 'a' to the end of the filename and try again.
+        bak_name = bak_name[:-4] + 'a.log'
+    return bak_name
@@ -6,42 +6,125 @@
 
     Dependancies:
         python3.5 or higher
-        lm-sensors
-        smartmontools
+        smartmontools 7.0 or higher (for --json)
+    Sensors are read from the kernel's hwmon interface (the same source lm-sensors uses).
 """
 
 import subprocess
 import os
 import sys
+import copy
+import threading
+import configparser
+import re
+import json
+import time
+import pwd
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
 
 # Decare local globals.
-report = {}
 path = os.path.abspath(os.path.dirname(__file__))
 globe = {
     "demo" : False,
-    "full_report" : True,
-    "command_line" : False
+    "command_line" : False,
+    "max_workers" : 8,
+    "smart_ttl" : 3600
 }
 
+# Limits OS commands running at once to max_workers across every collection, including nested pools such as
+# loadDrives() running loadSmart() for each disk. Replaced by loadConf() when max_workers changes.
+command_slots = {"max_workers": 8, "semaphore": threading.BoundedSemaphore(8)}
+
+# Names of the sections in a partial report and the sections only in a full report. See section_loaders.
+partial_sections = ["sensors", "memory", "logical_volumes", "cpu"]
+full_sections = ["various", "drives"]
+
+# What this host can report with, detected on the first collection and kept for the life of the process.
+# See detectCapabilities().
+capabilities = {}
+capabilities_lock = threading.Lock()
+
+# Last /proc/stat CPU sample, used to measure utilization between reports, and the utilization measured from it.
+# Samples less than a second apart (summed over all CPUs) are too coarse to measure, so the last result is reused.
+cpu_sample = []
+cpu_result = {}
+cpu_lock = threading.Lock()
+cpu_min_ticks = os.sysconf("SC_CLK_TCK") * (os.cpu_count() or 1)
+
+# CPU ticks of each process at the last measured listing as {pid: (start time, ticks, CPU%)}, used to measure CPU%
+# between listings. Listings less than process_min_seconds after it report its CPU% again. See listProcesses().
+process_sample = {"time": None, "ticks": {}}
+process_lock = threading.Lock()
+process_min_seconds = 1
+clock_ticks = os.sysconf("SC_CLK_TCK")
+page_kib = os.sysconf("SC_PAGE_SIZE") // 1024
+user_names = {}
+
+# Root of the kernel's hardware monitoring interface, and the sensors found under it. See mapHwmon().
+hwmon_path = "/sys/class/hwmon"
+hwmon_map = []
+hwmon_state = {"mapped": False}
+hwmon_lock = threading.Lock()
+
+# Sensor types read from hwmon, in the order sensors lists them, with the divisor from sysfs units to sensors units.
+hwmon_scales = {
+    "in": 1000,
+    "fan": 1,
+    "temp": 1000,
+    "power": 1000000,
+    "energy": 1000000,
+    "curr": 1000,
+    "humidity": 1000
+}
+
+# Block device tree read from /sys/block, reused until the devices or partitions there change. See mapDrives().
+sys_block_path = "/sys/block"
+drive_map = {"signature": None, "tree": []}
+drive_lock = threading.Lock()
+
+# SMART results by drive serial number as {serial: {"time", "health", "attributes"}}, and the serial last seen on
+# each device. Results are reused for smart_ttl seconds, and for as long as a drive is in standby. See loadSmart().
+smart_cache = {}
+smart_serials = {}
+smart_lock = threading.Lock()
+
+# Headers of SMART attributes, as smartctl -A prints them.
+smart_headers = ["attr_id", "attribute_name", "flag", "value", "worst", "thresh", "type", "updated", "when_failed", "raw_value"]
+
+# Seconds to wait before reading an input that failed again, doubling with each failure up to the max.
+hwmon_retry = 60
+hwmon_retry_max = 3600
+
+# Limits are read once when sensors are mapped, in the order sensors lists them. Inputs are read every sample.
+hwmon_limits = ["min", "max", "lcrit", "crit", "crit_hyst", "max_hyst", "emergency", "cap", "average", "lowest", "highest"]
+
 """
     Target function regardless of running from CLI or other file.
     This functioon will default to providing a full report for a CLI-User unless specified otherwise.
+    Optionally, pass a list of section names to collect only those sections.
 """
-def main(full_report=True, user="CLI-User"):
+def main(full_report=True, user="CLI-User", sections=None):
+    return collect(full_report, user, sections)
 
-    # Ensure clear report.
-    report.clear()
+"""
+    Builds the report for main(). Each call collects into its own report, so callers collecting different sections
+    do not wait on each other.
+"""
+def collect(full_report, user, sections):
 
-    # Initialize logger.
-    global logger
+    # Start a new report for this call.
+    report = {}
+
+    # Initialize a logger for this collection. It is passed to each loader so events are logged under this user.
     logger = Logger(user, "metrics.py")
-    logger.write('Began collecting metrics: ' + ' '.join(sys.argv[:]) + ' --------------')
+    logger.debug('Began collecting metrics: ' + ' '.join(sys.argv[:]) + ' --------------')
 
     # Ensure pythong version requirement.
     if sys.version_info < (3,5):
-        logger.write('Minimum required python version: 3.5')
-        logger.write('Python version detected: ' + str(sys.version_info[0]) + '.' + str(sys.version_info[1]))
+        logger.error('Minimum required python version: 3.5')
+        logger.error('Python version detected: ' + str(sys.version_info[0]) + '.' + str(sys.version_info[1]))
         print('Minimum python requirement is not met. See whm.log.')
         exit(1)
 
@@ -50,74 +133,110 @@ def main(full_report=True, user="CLI-User"):
         globe["command_line"] = True
         # If ran from command line, check params and ensure proper usage.
         if len(sys.argv) == 2 and sys.argv[1] == "update":
-            globe["full_report"] = False
-            logger.write('Running partial report.')
+            full_report = False
+            logger.debug('Running partial report.')
         elif len(sys.argv) != 1:
             print("Use no argument for a full report or use 'update' for a partial report.")
-            logger.write('Unexprected parameters - Did not collect metrics.')
+            logger.error('Unexprected parameters - Did not collect metrics.')
             exit(2)
 
-    # Remember if a partial report was requested. This is not applicable to CLI usage.
-    if not globe["command_line"]:
-        globe["full_report"] = full_report
-
     # Check if demo mode should be used.
-    if iAmAVirt():
+    if detectCapabilities(logger)["demo"]:
         globe["demo"] = True
-        logger.write("Demo Mode - Using sample data.")
+        logger.debug("Demo Mode - Using sample data.")
         report["demo"] = True
     else:
         report["demo"] = False
 
 
-    # Load partial report.
-    loadSensors()
-    loadMemory()
-    loadLogicalV()
-    loadCpu()
+    # Load parallelism cap.
+    loadConf()
 
-    # Load the rest of the report if needed.
-    if globe["full_report"]:
-        loadVarious()
-        loadDrives()
-        loadProcesses()
+    # Load partial report, and the rest of the report if needed, unless specific sections were requested.
+    if sections is None:
+        sections = partial_sections[:]
+        if full_report:
+            sections += full_sections
 
-    # Print, log, and return report where applicable.
+    # Sections are independent of each other and are collected concurrently.
+    runConcurrently([(section_loaders[section], (report, logger)) for section in sections])
+
+    # Print, log, and return report where applicable. A copy is returned so data cached for later reports is not changed through it.
     if globe["command_line"]:
         print(report)
-    logger.write("Report Generated. Full report: " + str(globe["full_report"]) + " --------------")
-    return(report)
+    logger.debug("Report Generated. Full report: " + str(full_report) + " --------------")
+    return(copy.deepcopy(report))
+
+"""
+    Loads the number of OS commands that may run at once from whm.cfg. 1 collects one section at a time.
+    Also loads how many seconds SMART results are reused for.
+"""
+def loadConf():
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(path, "whm.cfg"))
+    try:
+        globe["max_workers"] = max(1, config.getint("metrics", "max_workers"))
+    except:
+        # Config is missing this setting, keep the default.
+        pass
+    if command_slots["max_workers"] != globe["max_workers"]:
+        command_slots["semaphore"] = threading.BoundedSemaphore(globe["max_workers"])
+        command_slots["max_workers"] = globe["max_workers"]
+    try:
+        globe["smart_ttl"] = max(0, config.getint("metrics", "smart_ttl"))
+    except:
+        pass
+
+"""
+    Takes a list of (function, args tuple) pairs and runs them in a thread pool capped by max_workers.
+    Returns once every call has finished. Exceptions raised by a call are raised here.
+    Pools may be nested, so the cap on OS commands is kept by toOS() rather than by the pool.
+"""
+def runConcurrently(calls):
+    with ThreadPoolExecutor(max_workers=globe["max_workers"]) as pool:
+        futures = [pool.submit(func, *args) for (func, args) in calls]
+    for future in futures:
+        future.result()
 
 """
-    Checks to see what sensors returns with. A return code of 1 indicates that system doesn't see local sensors.
+    Checks for hardware sensors under /sys/class/hwmon. Hosts without any are likely virtual.
     Returns True if this is on a virt, else returns False.
 """
 def iAmAVirt():
-    # Attempt to pull sensor data.
-    (sensorsOut, sensorsRC) = toOS("sensors -u")
-    if sensorsOut == "failed":
-        logger.write("Exiting - iAmAVirt()")
-        exit(3)
-
-    # A return code of 1 indicates sensors do not apply here and this is likely a virtual environment.
-    if sensorsRC == 1:
-        return True
-    else:
-        return False
+    return len(mapHwmon()) == 0
+
+"""
+    Returns capabilities, detecting them on the first call: {"demo", "hwmon", "smartctl", "dmesg", "ifconfig"}.
+    hwmon is True if the host has hardware sensors, and demo is True if it does not. The rest are True if the tool
+    is installed. Missing tools are logged once here to logger, and collectors skip them instead of running them every
+    report.
+"""
+def detectCapabilities(logger):
+    with capabilities_lock:
+        if not capabilities:
+            capabilities["hwmon"] = not iAmAVirt()
+            capabilities["demo"] = not capabilities["hwmon"]
+            for tool in ["smartctl", "dmesg", "ifconfig"]:
+                capabilities[tool] = shutil.which(tool) is not None
+                if not capabilities[tool]:
+                    logger.warn("Not installed, will not be used: " + tool)
+        return capabilities
 
 """
     Load and report sensor data. Temperature and power stats.
+    Live values are read from the sensor files found by mapHwmon(). Demo mode parses sample sensors -u output.
 """
-def loadSensors():
-    # Load sensor info (virts use sample output).
+def loadSensors(report, logger):
     if not globe["demo"]:
-        (sensorsOut, rc) = toOS("sensors -u")
-    else:
-        (sensorsOut, rc) = toOS("cat " + os.path.join(path, "samples/sample-sensors.txt"))
+        loadHwmon(report)
+        return()
+
+    # Load sample sensor info.
+    (sensorsOut, rc) = toOS("cat " + os.path.join(path, "samples/sample-sensors.txt"), logger)
 
     # Check for errors.
     if rc != 0:
-        logger.write("Failed to load sensor info.")
+        logger.error("Failed to load sensor info.")
         return()
 
     # Split output by device.
@@ -183,118 +302,420 @@ def loadSensors():
         devicen += 1
 
 """
-    Load and report memory utilization.
+    Reports sensors from the hwmon map in the same layout sensors -u output is parsed into:
+    {"deviceN": {"name0": chip name, "name1": adapter, "values": {"temp1_input": "45.000", ...}}}.
+    Only input files are read. If one is gone, the map is rebuilt on the next sample. Inputs that exist but fail to
+    read, such as those of a suspended device or an unconnected channel, are left out and retried less often.
 """
-def loadMemory():
-    # Load memory stats (works on virts).
-    (freeOut, rc) = toOS("free -o | tail -n +2")
-
-    # Check for errors.
-    if rc != 0:
-        logger.write("Failed to load memory info.")
-        return()
+def loadHwmon(report):
+    report["sensors"] = {}
+    devicen = 0
+    for device in mapHwmon():
+        values = {}
+        for key in device["keys"]:
+            if key in device["limits"]:
+                values[key] = device["limits"][key]
+                continue
+            (sensorPath, scale) = device["inputs"][key]
+            failed = device["failed"].get(key)
+            if failed is not None and time.time() < failed[1]:
+                continue
+            try:
+                values[key] = "%.3f" % (int(readSys(sensorPath)) / scale)
+                device["failed"].pop(key, None)
+            except FileNotFoundError:
+                # Sensor went away. Look for sensors again next time.
+                hwmon_state["mapped"] = False
+            except (OSError, ValueError):
+                # Sensor is not ready. Wait longer after each failure before reading it again.
+                failures = failed[0] + 1 if failed is not None else 1
+                device["failed"][key] = (failures, time.time() + min(hwmon_retry * 2 ** (failures - 1), hwmon_retry_max))
+        report["sensors"]["device" + str(devicen)] = {
+            "name0": device["name0"],
+            "name1": device["name1"],
+            "values": values
+        }
+        devicen += 1
 
-    # Parse output.
-    report["memory"] = {}
-    i = 0
-    freeOutLen = len(freeOut)
-    while i < freeOutLen:           # until end of file
-        # Build name.
-        name = ""
-        while freeOut[i] != ":":
-            name += freeOut[i]
-            i += 1
-        i += 1
+"""
+    Returns the sensors under /sys/class/hwmon as a list of devices, each {"name0", "name1", "keys": value names in
+    the order sensors lists them, "inputs": {key: (input file path, divisor)}, "limits": {key: formatted value},
+    "failed": {key: (failures, time to read it again)} for inputs that failed to read}.
+    The directory is only scanned the first time or after loadHwmon() finds a sensor missing.
+"""
+def mapHwmon():
+    with hwmon_lock:
+        if hwmon_state["mapped"]:
+            return hwmon_map
+
+        devices = []
+        try:
+            entries = sorted(os.listdir(hwmon_path), key=lambda entry: int(re.sub("[^0-9]", "", entry) or 0))
+        except OSError:
+            entries = []
+        for entry in entries:
+            directory = os.path.join(hwmon_path, entry)
+            try:
+                name = readSys(os.path.join(directory, "name"))
+                files = os.listdir(directory)
+            except OSError:
+                continue
+
+            # Sort sensor files into inputs, to be read each sample, and limits, read now.
+            device = {"keys": [], "inputs": {}, "limits": {}, "failed": {}}
+            order = {}
+            for filename in files:
+                match = re.match("^([a-z]+)([0-9]+)_([a-z_]+)$", filename)
+                if not match or not match.group(1) in hwmon_scales:
+                    continue
+                (kind, number, attribute) = match.groups()
+                scale = hwmon_scales[kind]
+                if attribute == "input":
+                    device["inputs"][filename] = (os.path.join(directory, filename), scale)
+                    rank = 0
+                elif attribute in hwmon_limits:
+                    try:
+                        device["limits"][filename] = "%.3f" % (int(readSys(os.path.join(directory, filename))) / scale)
+                    except (OSError, ValueError):
+                        continue
+                    rank = hwmon_limits.index(attribute) + 1
+                else:
+                    continue
+                order[filename] = (list(hwmon_scales).index(kind), int(number), rank)
+
+            # Skip devices without anything to measure.
+            if not device["inputs"]:
+                continue
+            device["keys"] = sorted(order, key=lambda key: order[key])
+            (device["name0"], device["name1"]) = hwmonChipName(directory, name)
+            devices.append(device)
+
+        hwmon_map[:] = devices
+        hwmon_state["mapped"] = True
+        return hwmon_map
 
-        # Build total.
-        total = ""
-        while freeOut[i] == " ":    # skip spaces
-            i += 1
-        while freeOut[i] != " ":
-            total += freeOut[i]
-            i += 1
+"""
+    Returns (chip name, adapter) for the hwmon device at directory with the given driver name, named the way
+    lm-sensors names them, e.g. ("k10temp-pci-00c3", "PCI adapter") or ("coretemp-isa-0000", "ISA adapter"), so
+    recorded history carries on from sensors output.
+"""
+def hwmonChipName(directory, name):
+    device = os.path.join(directory, "device")
+    if not os.path.exists(device):
+        return (name + "-virtual-0", "Virtual device")
+    real = os.path.realpath(device)
+    subsystem = os.path.basename(os.path.realpath(os.path.join(device, "subsystem")))
+    base = os.path.basename(real)
+
+    # PCI devices are addressed by domain, bus, slot and function. Devices on other buses use their PCI parent.
+    pci = [part for part in real.split("/") if re.match("^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\\.[0-7]$", part)]
+    if subsystem == "i2c" and re.match("^[0-9]+-[0-9a-f]{4}$", base):
+        (bus, address) = base.split("-")
+        try:
+            adapter = readSys(os.path.join(os.path.dirname(real), "name"))
+        except OSError:
+            adapter = "I2C adapter"
+        return ("%s-i2c-%d-%02x" % (name, int(bus), int(address, 16)), adapter)
+    if subsystem in ["platform", "of_platform", "isa"]:
+        number = re.search("\\.([0-9]+)$", base)
+        return ("%s-isa-%04x" % (name, int(number.group(1)) if number else 0), "ISA adapter")
+    if subsystem == "acpi":
+        number = re.search(":([0-9]+)$", base)
+        return ("%s-acpi-%x" % (name, int(number.group(1)) if number else 0), "ACPI interface")
+    if pci:
+        (domain, bus, slot) = pci[-1].split(":")
+        (slot, function) = slot.split(".")
+        address = (int(domain, 16) << 16) + (int(bus, 16) << 8) + (int(slot, 16) << 3) + int(function)
+        return ("%s-pci-%04x" % (name, address), "PCI adapter")
+    return (name + "-virtual-0", "Virtual device")
 
-        # Build used.
-        used = ""
-        while freeOut[i] == " ":    #skip spaces
-            i += 1
-        while freeOut[i] != " ":
-            used += freeOut[i]
-            i += 1
+"""
+    Returns the stripped contents of a small sysfs or procfs file.
+"""
+def readSys(filePath):
+    with open(filePath) as sysFile:
+        return sysFile.read().strip()
 
-        # Burn through rest of line.
-        while ord(freeOut[i]) != 10:
-            i += 1
-        i += 1
+"""
+    Load and report memory utilization. Values are read from /proc/meminfo in kB, the same units free reports.
+"""
+def loadMemory(report, logger):
+    # Load memory stats (works on virts).
+    try:
+        with open("/proc/meminfo") as meminfo:
+            fields = {}
+            for line in meminfo:
+                (name, value) = line.split(":", 1)
+                fields[name] = int(value.split()[0])
+    except:
+        logger.error("Failed to load memory info.")
+        return()
 
-        # Report data.
+    # Report data. Used is total minus free as reported by "free -o".
+    report["memory"] = {}
+    for (name, total, free) in [("Mem", fields["MemTotal"], fields["MemFree"]), ("Swap", fields["SwapTotal"], fields["SwapFree"])]:
+        used = total - free
         report["memory"][name] = {
-            "total": total,
-            "used": used,
-            "free": str(int(total) - int(used)),
-            "utilization": str(round(int(used) / int(total) * 100, 2))
+            "total": str(total),
+            "used": str(used),
+            "free": str(free),
+            "utilization": str(round(used / total * 100, 2) if total > 0 else 0.0)
         }
 
 """
     Load and report logical volume information. Specifically, utilization.
+    Live usage is measured with statvfs for each mounted file system, in the same fields df reports.
 """
-def loadLogicalV():
-    # Load logical volume utilization (virts use sample output).
+def loadLogicalV(report, logger):
     if not globe["demo"]:
-        (dfOut, rc) = toOS("df | tail -n +2")
-    else:
-        (dfOut, rc) = toOS("cat " + os.path.join(path, "samples/sample-df.txt"))
+        try:
+            report["logical_volumes"] = volumeUsage()
+        except:
+            logger.error("Failed to load logical volume info.")
+        return()
+
+    # Load sample logical volume utilization.
+    (dfOut, rc) = toOS("cat " + os.path.join(path, "samples/sample-df.txt"), logger)
 
     # Check for errors.
     if rc != 0:
-        logger.write("Failed to load logical volume info.")
+        logger.error("Failed to load logical volume info.")
         return()
 
     # Parse output with headers/keys that apply to df and report.
     report["logical_volumes"] = parseLines(dfOut, ["filesystem", "k_blocks", "used", "available", "use_percent", "mount_point"])
 
 """
-    Load and report CPU utilization metrics.
+    Returns usage of each mounted file system from /proc/self/mounts as a list of dicts with the fields df prints:
+    filesystem, k_blocks, used, available, use_percent and mount_point. Like df, file systems without any blocks
+    (proc, sysfs, cgroup, ...) are skipped and a file system mounted more than once is only listed once.
 """
-def loadCpu():
-    # Load CPU utilization.
-    (topOut, rc) = toOS("top -b -n1 | grep Cpu | tr -d '\n'")
+def volumeUsage():
+    volumes = []
+    seen = set()
+    with open("/proc/self/mounts") as mounts:
+        for line in mounts:
+            fields = line.split()
+            (source, mountPoint) = (fields[0], unescapeMount(fields[1]))
+            try:
+                stats = os.statvfs(mountPoint)
+                device = os.stat(mountPoint).st_dev
+            except OSError:
+                continue
+            if stats.f_blocks == 0 or device in seen:
+                continue
+            seen.add(device)
+
+            # Used is everything not free, and use% rounds up, as df does.
+            used = (stats.f_blocks - stats.f_bfree) * stats.f_frsize // 1024
+            available = stats.f_bavail * stats.f_frsize // 1024
+            percent = -(-used * 100 // (used + available)) if used + available > 0 else 0
+            volumes.append({
+                "filesystem": source,
+                "k_blocks": str(stats.f_blocks * stats.f_frsize // 1024),
+                "used": str(used),
+                "available": str(available),
+                "use_percent": str(percent) + "%",
+                "mount_point": mountPoint
+            })
+    return volumes
 
-    # Check for errors.
-    if rc != 0:
-        logger.write("Failed to load CPU info.")
+"""
+    Returns a path from /proc/self/mounts with its octal escapes (e.g. \\040 for a space) decoded.
+"""
+def unescapeMount(mountPath):
+    return re.sub("\\\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), mountPath)
+
+"""
+    Load and report CPU utilization metrics.
+    Utilization is the change in /proc/stat jiffies since the previous call. The first call reports
+    utilization since boot, which is also what a single iteration of top reports. Calls less than a second
+    after the last measurement report that measurement again.
+"""
+def loadCpu(report, logger):
+    # Load aggregate CPU jiffies: user, nice, system, idle, iowait, irq, softirq, steal.
+    try:
+        with open("/proc/stat") as stat:
+            sample = [int(x) for x in stat.readline().split()[1:9]]
+    except:
+        logger.error("Failed to load CPU info.")
         return()
 
-    # Add info to report based on position in string - these values should always be in the same place.
-    report["cpu"] = {
-        "user": topOut[8:13].replace(" ", ""),
-        "system": topOut[17:22].replace(" ", ""),
-        "niced": topOut[26:31].replace(" ", ""),
-        "idle": topOut[35:40].replace(" ", ""),
-        "waiting": topOut[44:49].replace(" ", ""),
-        "hw_interrupt": topOut[53:58].replace(" ", ""),
-        "sw_interrupt": topOut[62:67].replace(" ", ""),
-        "stolen": topOut[71:76].replace(" ", "")
-    }
+    with cpu_lock:
+        # Reuse the last result if too little time has passed to measure, keeping the previous sample to compare with.
+        if cpu_result and sum(sample) - sum(cpu_sample) < cpu_min_ticks:
+            report["cpu"] = dict(cpu_result)
+            return()
+
+        # Compare with the previous sample when there is one, and remember this sample for the next call.
+        delta = sample
+        if cpu_sample and sum(sample) > sum(cpu_sample):
+            delta = [now - then for (now, then) in zip(sample, cpu_sample)]
+        cpu_sample[:] = sample
+        total = sum(delta)
+
+        # Add info to report as percentages of total time, in the same order top uses.
+        (user, niced, system, idle, waiting, hw_interrupt, sw_interrupt, stolen) = [str(round(x / total * 100, 1)) for x in delta]
+        cpu_result.update({
+            "user": user,
+            "system": system,
+            "niced": niced,
+            "idle": idle,
+            "waiting": waiting,
+            "hw_interrupt": hw_interrupt,
+            "sw_interrupt": sw_interrupt,
+            "stolen": stolen
+        })
+        report["cpu"] = dict(cpu_result)
 
 """
     Creates a nesting map of physical and logical disk and collects relavent info such as size.
     Then SMART values are loaded. All data is added to the report.
+    The live map is built from /sys/block by mapDrives(). Demo mode parses sample lsblk output.
 """
-def loadDrives():
-    # Load drive map and stats (demo mode uses sample output).
+def loadDrives(report, logger):
     if not globe["demo"]:
-        (lsblkOut, lsblkrc) = toOS("lsblk | tail -n +2")
+        try:
+            report["drives"] = mapDrives()
+        except:
+            logger.error("Failed to load drive map info.")
+            return()
     else:
-        (lsblkOut, lsblkrc) = toOS("cat " + os.path.join(path, "samples/sample-lsblk.txt"))
+        # Load sample drive map and stats.
+        (lsblkOut, lsblkrc) = toOS("cat " + os.path.join(path, "samples/sample-lsblk.txt"), logger)
 
-    # Check for errors.
-    if lsblkrc != 0:
-        logger.write("Failed to load drive map info.")
-        return()
+        # Check for errors.
+        if lsblkrc != 0:
+            logger.error("Failed to load drive map info.")
+            return()
+        report["drives"] = parseLsblk(lsblkOut)
+
+    # Load SMART values for all disks. Each disk is queried on its own thread.
+    runConcurrently([(loadSmart, (report, device, logger)) for device in report["drives"] if report["drives"][device]["type"] == "disk"])
+
+"""
+    Returns the drive map, as parsed from lsblk, for the block devices on this host:
+    {name: {"size": "1.8T", "type": "disk", "mount": "/srv", "children": {name: {...}}}}. "mount" and "children"
+    are only present when they apply. The tree is cached and only rebuilt when the devices in /sys/block or
+    /proc/partitions change. Sizes and mount points are read every call.
+"""
+def mapDrives():
+    # Sizes of every device and partition, listed in 1K blocks.
+    sizes = {}
+    with open("/proc/partitions") as partitions:
+        for line in partitions.readlines()[2:]:
+            fields = line.split()
+            if len(fields) == 4:
+                sizes[fields[3]] = int(fields[2]) * 1024
+
+    # Rebuild the tree if a device or partition was added or removed.
+    signature = (tuple(sorted(os.listdir(sys_block_path))), tuple(sorted(sizes)))
+    with drive_lock:
+        if signature != drive_map["signature"]:
+            drive_map["tree"] = [driveNode(os.path.join(sys_block_path, name), name) for name in signature[0] if isRootDrive(name)]
+            drive_map["signature"] = signature
+        tree = drive_map["tree"]
+
+    # Mount points by kernel device name, with active swap shown as lsblk shows it.
+    mounts = {}
+    with open("/proc/self/mounts") as mountsFile:
+        for line in mountsFile:
+            (source, mountPoint) = line.split()[:2]
+            if source.startswith("/dev/"):
+                mounts.setdefault(os.path.basename(os.path.realpath(source)), unescapeMount(mountPoint))
+    with open("/proc/swaps") as swaps:
+        for line in swaps.readlines()[1:]:
+            mounts.setdefault(os.path.basename(os.path.realpath(line.split()[0])), "[SWAP]")
+
+    return fillDrives(tree, sizes, mounts)
+
+"""
+    Returns True if the device name in /sys/block belongs at the top of the drive map. Devices built on other
+    devices (RAID, LVM, ...) are listed under them instead, and RAM disks are left out as lsblk does.
+"""
+def isRootDrive(name):
+    directory = os.path.join(sys_block_path, name)
+    if re.match("^ram[0-9]+$", name):
+        return False
+    try:
+        return len(os.listdir(os.path.join(directory, "slaves"))) == 0
+    except OSError:
+        return True
+
+"""
+    Returns the tree node for the block device or partition in directory: {"name", "kernel": kernel name, "type",
+    "children": partitions, then devices built on this one}.
+"""
+def driveNode(directory, kernelName):
+    node = {
+        "name": kernelName,
+        "kernel": kernelName,
+        "type": "disk",
+        "children": []
+    }
+
+    # Determine the type as lsblk does.
+    if os.path.exists(os.path.join(directory, "partition")):
+        node["type"] = "part"
+    elif os.path.exists(os.path.join(directory, "md", "level")):
+        node["type"] = readSys(os.path.join(directory, "md", "level"))
+    elif os.path.exists(os.path.join(directory, "dm", "name")):
+        node["name"] = readSys(os.path.join(directory, "dm", "name"))
+        uuid = readSys(os.path.join(directory, "dm", "uuid")) if os.path.exists(os.path.join(directory, "dm", "uuid")) else ""
+        node["type"] = {"LVM": "lvm", "CRYPT": "crypt", "mpath": "mpath"}.get(uuid.split("-")[0], "dm")
+    elif kernelName.startswith("loop"):
+        node["type"] = "loop"
+    elif os.path.exists(os.path.join(directory, "device", "type")) and readSys(os.path.join(directory, "device", "type")) == "5":
+        node["type"] = "rom"
+
+    # Partitions are subdirectories with a partition file. Holders are devices built on this one.
+    for entry in sorted(os.listdir(directory)):
+        if os.path.exists(os.path.join(directory, entry, "partition")):
+            node["children"].append(driveNode(os.path.join(directory, entry), entry))
+    if os.path.isdir(os.path.join(directory, "holders")):
+        for holder in sorted(os.listdir(os.path.join(directory, "holders"))):
+            node["children"].append(driveNode(os.path.join(sys_block_path, holder), holder))
+    return node
+
+"""
+    Returns the report layout for tree nodes from driveNode(), with current sizes and mount points.
+    Unused loop devices, which have no size, are left out as lsblk does.
+"""
+def fillDrives(nodes, sizes, mounts):
+    drives = {}
+    for node in nodes:
+        size = sizes.get(node["kernel"], 0)
+        if size == 0 and node["type"] == "loop":
+            continue
+        drives[node["name"]] = {
+            "size": humanSize(size),
+            "type": node["type"]
+        }
+        if node["kernel"] in mounts:
+            drives[node["name"]]["mount"] = mounts[node["kernel"]]
+        children = fillDrives(node["children"], sizes, mounts)
+        if children:
+            drives[node["name"]]["children"] = children
+    return drives
+
+"""
+    Returns a size in bytes the way lsblk prints it: powers of 1024 with at most one decimal, e.g. "111.8G" or "243M".
+"""
+def humanSize(size):
+    units = ["B", "K", "M", "G", "T", "P", "E"]
+    exponent = 0
+    while exponent < len(units) - 1 and size >= 1024 ** (exponent + 1):
+        exponent += 1
+    text = "%.1f" % (size / 1024 ** exponent)
+    if text.endswith(".0"):
+        text = text[:-2]
+    return text + units[exponent]
 
-    # Parse drive map info.
-    report["drives"] = {}
+"""
+    Takes lsblk output without its header line and returns the drive map described in mapDrives().
+"""
+def parseLsblk(lsblkOut):
+    drives = {}
     heritage = []
     lsblkOutLen = len(lsblkOut)
     i = 0                   # i is index in output
@@ -358,9 +779,9 @@ def loadDrives():
                 heritage[len(heritage) - 1] = [name, j]
 
             # Add info to report.
-            parent = report["drives"]
+            parent = drives
             if j > 0:
-                ancestor = report["drives"][heritage[0][0]]
+                ancestor = drives[heritage[0][0]]
                 for x in range(1, len(heritage) - 1):
                     ancestor = ancestor["children"][heritage[x][0]]
                 if not "children" in ancestor:
@@ -373,81 +794,251 @@ def loadDrives():
             if len(mount) > 0:
                 parent[name]["mount"] = mount
         i += 1
+    return drives
 
-    # Load, process and report SMART values for all drives.
-    headers = ["attr_id", "attribute_name", "flag", "value", "worst", "thresh", "type", "updated", "when_failed", "raw_value"]
-    for device in report["drives"]:
-        # Ensure device is disk
-        if report["drives"][device]["type"] != "disk":
-            continue
+"""
+    Load, process and report SMART values for one disk from report["drives"].
+    Live values come from one smartctl call per drive, which does not wake drives in standby. Results are cached
+    by serial number for smart_ttl seconds, and a drive in standby is reported from its last result.
+    Drives whose SMART data cannot be read are reported with UNKNOWN health and no attributes.
+"""
+def loadSmart(report, device, logger):
+    # Start with the values reported when SMART data cannot be read.
+    report["drives"][device]["smart_health"] = "UNKNOWN"
+    report["drives"][device]["sn"] = ""
+    report["drives"][device]["smart_attributes"] = []
 
-        # Load SMART info: -H for overal health and -A for SMART attributes (virts use sample output).
-        if not globe["demo"]:
-            (smartHOut, smartrc) = toOS("smartctl -H /dev/" + device + " | grep result")
-            (smartAOut, smartrc) = toOS("smartctl -A /dev/" + device + " | tail -n +8 | head -n -1")
-            (snOut, snrc) = toOS("smartctl -i /dev/" + device + " | grep 'Serial Number:' | cut -c19-")
+    if not globe["demo"]:
+        # Without smartctl, drives are listed without SMART data.
+        if not capabilities["smartctl"]:
+            report["drives"][device]["smart_health"] = "smartctl is not installed."
+            report["drives"][device]["sn"] = driveSerial(device) or "smartctl is not installed."
+            return()
+        smart = liveSmart(device, logger)
+        if smart is None:
+            logger.error("Failed to load SMART data.")
+            report["drives"][device]["sn"] = driveSerial(device) or ""
+            return()
+        report["drives"][device]["smart_health"] = smart["health"]
+        report["drives"][device]["sn"] = smart["serial"]
+        report["drives"][device]["smart_attributes"] = smart["attributes"]
+        if smart["standby"]:
+            report["drives"][device]["standby"] = True
+        return()
 
-        else:
-            (smartHOut, smartrc) = toOS("cat " + os.path.join(path, "samples/sample-smart-H-PASSED.txt"))
-            (smartAOut, smartrc) = toOS("cat " + os.path.join(path, "samples/sample-smartA" + device + ".txt"))
-            (snOut, snrc) = toOS("cat " + os.path.join(path, "samples/sample-sn.txt"))
-            # Make fake sn unique.
-            snOut =snOut[:-1] + device.upper()
+    # Load sample SMART info: -H for overal health and -A for SMART attributes.
+    (smartHOut, smartrc) = toOS("cat " + os.path.join(path, "samples/sample-smart-H-PASSED.txt"), logger)
+    (smartAOut, smartrc) = toOS("cat " + os.path.join(path, "samples/sample-smartA" + device + ".txt"), logger)
+    (snOut, snrc) = toOS("cat " + os.path.join(path, "samples/sample-sn.txt"), logger)
+    # Make fake sn unique.
+    snOut =snOut[:-1] + device.upper()
 
-            # Check for errors.
-            if smartrc != 0:
-                logger.write("Failed to load SMART data.")
-                return()
+    # Check for errors.
+    if smartrc != 0:
+        logger.error("Failed to load SMART data.")
+        return()
 
-        # Add overall health status to report.
-        report["drives"][device]["smart_health"] = smartHOut[50:].replace("\n", "")
-        # Add sn info to report.
-        report["drives"][device]["sn"] = snOut
-        # Parse output with headers/keys that apply to SMART attributes and report.
-        report["drives"][device]["smart_attributes"] = parseLines(smartAOut, headers)
+    # Add overall health status to report.
+    report["drives"][device]["smart_health"] = smartHOut[50:].replace("\n", "")
+    # Add sn info to report.
+    report["drives"][device]["sn"] = snOut
+    # Parse output with headers/keys that apply to SMART attributes and report.
+    report["drives"][device]["smart_attributes"] = parseLines(smartAOut, smart_headers)
 
 """
-    Adds running processes to report.
+    Returns {"serial", "health", "attributes", "standby"} for device, from the cache while it is fresh and from
+    smartctl otherwise. Returns None if SMART data could not be read.
 """
-def loadProcesses():
-    # Load processes for parsing (works on virts).
-    (psOut, rc) = toOS("ps -A | tail -n +2")
+def liveSmart(device, logger):
+    # Use the cached result for this drive while it is fresh.
+    serial = driveSerial(device)
+    with smart_lock:
+        cached = smart_cache.get(serial)
+    if cached is not None and time.time() - cached["time"] < globe["smart_ttl"]:
+        return dict(cached, serial=serial, standby=False)
+
+    # Everything in one call. -n standby skips drives that are spun down instead of waking them.
+    (smartOut, smartrc) = toOS("smartctl -x --json -n standby /dev/" + device, logger)
+    try:
+        data = json.loads(smartOut)
+    except ValueError:
+        return None
+
+    # Bits 0 and 1 of the exit status mean nothing was read, as happens when the drive is in standby.
+    if smartrc & 3:
+        messages = " ".join(message.get("string", "") for message in data.get("smartctl", {}).get("messages", []))
+        if not "STANDBY" in messages.upper() and not "SLEEP" in messages.upper():
+            return None
+        if cached is not None:
+            return dict(cached, serial=serial, standby=True)
+        return {"serial": serial or "", "health": "STANDBY", "attributes": [], "standby": True}
+
+    # Cache the result under the drive's serial number.
+    serial = data.get("serial_number", serial or "")
+    status = data.get("smart_status", {})
+    result = {
+        "time": time.time(),
+        "health": ("PASSED" if status["passed"] else "FAILED!") if "passed" in status else "UNKNOWN",
+        "attributes": smartAttributes(data)
+    }
+    with smart_lock:
+        smart_cache[serial] = result
+        smart_serials[device] = serial
+    return dict(result, serial=serial, standby=False)
 
-    # Check for errors.
-    if rc != 0:
-        logger.write("Failed to load processes.")
-        return()
+"""
+    Returns the serial number of device from sysfs, or the one smartctl last reported for it. Returns None if unknown.
+"""
+def driveSerial(device):
+    # NVMe drives list it directly. SCSI and SATA drives have it in the unit serial number VPD page.
+    try:
+        return readSys(os.path.join(sys_block_path, device, "device", "serial"))
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(sys_block_path, device, "device", "vpd_pg80"), "rb") as page:
+            serial = page.read()[4:].decode(errors="replace").strip("\x00 \n")
+        if serial:
+            return serial
+    except OSError:
+        pass
+    with smart_lock:
+        return smart_serials.get(device)
 
-    # Parse output with headers/keys that apply to ps and report.
-    report["processes"] = parseLines(psOut, ["pid", "tty", "time", "cmd"])
+"""
+    Returns smartctl JSON output as rows of smart_headers, formatted the way smartctl -A prints them.
+    NVMe drives have no attribute table, so each health log entry becomes a row with its name and value.
+"""
+def smartAttributes(data):
+    attributes = []
+    for attribute in data.get("ata_smart_attributes", {}).get("table", []):
+        flags = attribute.get("flags", {})
+        attributes.append({
+            "attr_id": str(attribute.get("id", "")),
+            "attribute_name": attribute.get("name", ""),
+            "flag": "0x%04x" % flags.get("value", 0),
+            "value": "%03d" % attribute.get("value", 0),
+            "worst": "%03d" % attribute.get("worst", 0),
+            "thresh": "%03d" % attribute.get("thresh", 0),
+            "type": "Pre-fail" if flags.get("prefailure") else "Old_age",
+            "updated": "Always" if flags.get("updated_online") else "Offline",
+            "when_failed": attribute.get("when_failed") or "-",
+            "raw_value": attribute.get("raw", {}).get("string", "")
+        })
+    for (name, value) in data.get("nvme_smart_health_information_log", {}).items():
+        row = {header: "-" for header in smart_headers}
+        row["attr_id"] = ""
+        row["attribute_name"] = name
+        row["raw_value"] = str(value)
+        attributes.append(row)
+    return attributes
+
+"""
+    Returns a list of running processes read from /proc, each as {"pid", "user", "ppid", "state", "cpu", "rss", "time", "cmd"}.
+    cpu is the percent of one CPU used since the last listing, or over the process's lifetime on the first listing.
+    Listings too soon after the last one to measure report the CPU% it measured.
+    rss is resident memory in KiB and time is total CPU time. Processes that exit while being read are left out.
+"""
+def listProcesses():
+    # Uptime dates process start times for lifetime CPU%.
+    with open("/proc/uptime") as uptimeFile:
+        uptime = float(uptimeFile.read().split()[0])
+
+    processes = []
+    ticks = {}
+    with process_lock:
+        elapsed = uptime - process_sample["time"] if process_sample["time"] is not None else 0
+        measure = process_sample["time"] is None or elapsed >= process_min_seconds
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open("/proc/" + pid + "/stat") as statFile:
+                    stat = statFile.read()
+                with open("/proc/" + pid + "/cmdline", "rb") as cmdFile:
+                    cmd = cmdFile.read().rstrip(b"\0").replace(b"\0", b" ").decode(errors="replace")
+                uid = os.stat("/proc/" + pid).st_uid
+            except OSError:
+                continue
+
+            # The command name is in parentheses and may hold spaces, so fields are counted from the closing one.
+            name = stat[stat.index("(") + 1:stat.rindex(")")]
+            fields = stat[stat.rindex(")") + 2:].split()
+            used = int(fields[11]) + int(fields[12])
+            started = int(fields[19])
+
+            # Measure CPU% since the last listing if this process was in it, else over its lifetime.
+            last = process_sample["ticks"].get(pid)
+            if last is not None and last[0] == started and not measure:
+                cpu = last[2]
+            elif last is not None and last[0] == started and elapsed > 0:
+                cpu = (used - last[1]) / clock_ticks / elapsed * 100
+            else:
+                lifetime = uptime - started / clock_ticks
+                cpu = used / clock_ticks / lifetime * 100 if lifetime > 0 else 0
+            ticks[pid] = (started, used, cpu)
+
+            seconds = used // clock_ticks
+            processes.append({
+                "pid": int(pid),
+                "user": userName(uid),
+                "ppid": int(fields[1]),
+                "state": fields[0],
+                "cpu": round(cpu, 1),
+                "rss": int(fields[21]) * page_kib,
+                "time": "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60),
+                "cmd": cmd or "[" + name + "]"
+            })
+
+        # Remember this listing for the next one, unless it was too soon to measure.
+        if measure:
+            process_sample["time"] = uptime
+            process_sample["ticks"] = ticks
+    return processes
+
+"""
+    Returns the name of the user with uid, or the uid as a string if it has no name. Names are cached.
+"""
+def userName(uid):
+    if uid not in user_names:
+        try:
+            user_names[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            user_names[uid] = str(uid)
+    return user_names[uid]
 
 """
     Adds the following data to report: uptime, kernel-version, dmesg
     No special processing is needed for these outputs.
 """
-def loadVarious():
+def loadVarious(report, logger):
     # Report hostname.
-    (report['hostname'], hnrc) = toOS("hostname | tr -d '\n'")
+    (report['hostname'], hnrc) = toOS("hostname | tr -d '\n'", logger)
 
     # Report uptime (works on virts).
-    (report['uptime'], uprc) = toOS("uptime -p | cut -c 4- | tr -d '\n'")
+    (report['uptime'], uprc) = toOS("uptime -p | cut -c 4- | tr -d '\n'", logger)
 
     # Report kernel-version (works on virts).
-    (report["os"], unamerc) = toOS("uname -v | tr -d '\n'")
+    (report["os"], unamerc) = toOS("uname -v | tr -d '\n'", logger)
 
     # Report dmesg (virts use sample output).
-    if not globe["demo"]:
-        (report['dmesg'], dmesgrc) = toOS("dmesg | tail -n 200")
+    if globe["demo"]:
+        (report['dmesg'], dmesgrc) = toOS("cat " + os.path.join(path, "samples/sample-dmesg.txt"), logger)
+    elif capabilities["dmesg"]:
+        (report['dmesg'], dmesgrc) = toOS("dmesg | tail -n 200", logger)
     else:
-        (report['dmesg'], dmesgrc) = toOS("cat " + os.path.join(path, "samples/sample-dmesg.txt"))
+        (report['dmesg'], dmesgrc) = ("dmesg is not installed.", 0)
 
     # Load, but do not process network error info.
     # I am intentionally leaving this part of the report vague and unprocessed for security reasons.
-    (report["network"], networkrc) = toOS("ifconfig eth0 | tail -n +4")
+    if capabilities["ifconfig"]:
+        (report["network"], networkrc) = toOS("ifconfig eth0 | tail -n +4", logger)
+    else:
+        report["network"] = "ifconfig is not installed."
 
     # Check for errors.
     if uprc != 0 or unamerc != 0 or dmesgrc != 0:
-        logger.write("Failed to load uptime, kernel-verson, and/or dmesgrc.")
+        logger.error("Failed to load uptime, kernel-verson, and/or dmesgrc.")
 
 """
     Takes ([str]lines, [array of strings]headers) and returns an array of objects. These objects have keys from headers, and the
@@ -485,23 +1076,36 @@ def parseLines(lines, headers):
     return data
 
 """
-    Attempts to send a command to the OS. Accepts a command as a string and returns ([str]output, [int]returncode).
+    Attempts to send a command to the OS. Accepts a command as a string and the Logger to note it with, and returns
+    ([str]output, [int]returncode).
+    Waits for a free slot if max_workers commands are already running.
 """
-def toOS(command):
+def toOS(command, logger):
     # Attempt to send command to OS.
     try:
-        result = subprocess.run(command + " 2>&1", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+        with command_slots["semaphore"]:
+            result = subprocess.run(command + " 2>&1", stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
         out = result.stdout.decode('utf-8')
         rc = result.returncode
         if rc == 0:
-            logger.write('  Successfully ran: ' + command + '.')
+            logger.debug('  Successfully ran: ' + command + '.')
         else:
-            logger.write('  OS took command, but there was an issue: ' + command + '.')
+            logger.warn('  OS took command, but there was an issue: ' + command + '.')
         return (out, rc)
     except:
-        logger.write('  Host failed to handle :' + command)
+        logger.error('  Host failed to handle :' + command)
         return ("failed", -1)
 
+# Loader for each report section by name.
+section_loaders = {
+    "sensors": loadSensors,
+    "memory": loadMemory,
+    "logical_volumes": loadLogicalV,
+    "cpu": loadCpu,
+    "various": loadVarious,
+    "drives": loadDrives
+}
+
 # Run main once all functions are loaded.
 if __name__ == "__main__":
     main(True)
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+    Keeps an always-warm copy of the metrics report in memory as part of Web Host Manager.
+    Each report section is refreshed on its own thread at the interval configured in the [sampler]
+    section of whm.cfg. Requests read the latest snapshot instead of waiting on OS commands.
+
+    This is not intended to be executed independently.
+"""
+
+import threading
+import configparser
+import os
+import time
+import metrics
+from logger import Logger
+
+# Seconds between refreshes of each report section. 0 turns off background sampling for a section.
+intervals = {
+    "sensors": 15,
+    "memory": 15,
+    "logical_volumes": 60,
+    "cpu": 15,
+    "various": 300,
+    "drives": 600
+}
+
+# Latest data for each section, stored as {section: {'data': {report keys}, 'time': epoch seconds}}.
+snapshot = {}
+snapshot_demo = {'demo': False}
+snapshot_lock = threading.Lock()
+
+# Sampling threads and the event used to stop them.
+threads = []
+stop_event = threading.Event()
+
+logger = Logger("metrics-sampler", "sampler.py")
+
+"""
+    Loads section intervals from whm.cfg and starts a sampling thread for each section. Does nothing if already started.
+"""
+def start():
+    if threads:
+        return
+
+    # Load intervals, keeping defaults for any that are missing.
+    config = configparser.RawConfigParser()
+    config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), "whm.cfg"))
+    for section in intervals:
+        try:
+            intervals[section] = config.getint("sampler", section)
+        except:
+            pass
+
+    # Start a daemon thread per sampled section.
+    stop_event.clear()
+    for section in intervals:
+        if intervals[section] > 0:
+            thread = threading.Thread(target=run, args=(section,), name="sampler-" + section, daemon=True)
+            thread.start()
+            threads.append(thread)
+    logger.write("Started sampling: " + ", ".join(thread.name[8:] for thread in threads))
+
+"""
+    Stops all sampling threads.
+"""
+def stop():
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    del threads[:]
+
+"""
+    Thread target. Samples section now and then every interval until stopped.
+"""
+def run(section):
+    while True:
+        try:
+            update(metrics.main(True, "metrics-sampler", [section]), [section])
+        except:
+            # Keep the last good data and try again next interval.
+            logger.error("Failed to sample section: " + section)
+        if stop_event.wait(intervals[section]):
+            return
+
+"""
+    Stores sections of a report in the snapshot. Used by the sampling threads only, so every section in the snapshot
+    is one that is sampled in the background.
+"""
+def update(report, sections):
+    now = time.time()
+    with snapshot_lock:
+        snapshot_demo['demo'] = report.get('demo', False)
+        for section in sections:
+            keys = ["hostname", "uptime", "os", "dmesg", "network"] if section == "various" else [section]
+            snapshot[section] = {
+                'data': {key: report[key] for key in keys if key in report},
+                'time': now
+            }
+
+"""
+    Returns {'report': report built from the snapshot, 'age': seconds since its oldest section was sampled}.
+    Takes a list of section names. Returns None if any of them have not been sampled, or were last sampled more than
+    twice their interval ago (sampling is off or keeps failing), so the caller collects them instead.
+"""
+def get(sections):
+    now = time.time()
+    with snapshot_lock:
+        for section in sections:
+            if not section in snapshot or now - snapshot[section]['time'] > 2 * intervals.get(section, 0):
+                return None
+        report = {'demo': snapshot_demo['demo']}
+        oldest = time.time()
+        for section in sections:
+            report.update(snapshot[section]['data'])
+            oldest = min(oldest, snapshot[section]['time'])
+    return {
+        'report': report,
+        'age': round(time.time() - oldest, 1)
+    }
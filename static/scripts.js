@@ -5,6 +5,17 @@
 // Metrics report is stored globally.
 var report;
 
+// Charts waiting for their first data. See load_charts().
+var pending_charts = [];
+
+// The whm log being viewed: its name, the line number of the first line shown, and the text shown. See get_logs().
+var log_page = {'logname': 'whm.log', 'offset': 0, 'text': ''};
+var log_page_lines = 500;
+
+// The page of processes being viewed: its sort key and order, filter, and the index of its first process. See get_processes().
+var process_page = {'sort': 'cpu', 'order': 'desc', 'q': '', 'offset': 0};
+var process_page_size = 100;
+
 /*
     Declared in layout.html:
     var admin = '{{ session.admin }}';
@@ -45,9 +56,9 @@ function logged_in() {
         };
     }
 
-    // Handler to pull a new report.
-    $('#refresh').click(function() {
-        getReport();
+    // Handler to pull a new report. Admins can shift-click to collect a new report instead of the shared one.
+    $('#refresh').click(function(event) {
+        getReport(admin == 1 && event.shiftKey);
     });
 
     // Show demo banner if demo mode is detected.
@@ -90,6 +101,7 @@ function logged_in() {
     if (admin == 1) {
         $("#username").css("color", "red");
         $('.admin').show();
+        $('#refresh').attr('title', 'Shift-click to collect a new report');
     }
 }
 
@@ -498,36 +510,44 @@ function cpu() {
 
 /*
     Processes page route.
-    Add running processes to the html table and give admins access to process actions.
+    Load the first page of running processes and give admins access to process actions.
 */
 function processes() {
-    // This is hold the html to add to the table.
-    var rows_html = "";
-
-    // Order of table headers.
-    var ordered_keys = ['pid', 'tty', 'time', 'cmd'];
-
-    // For each process, start a new table row and add process details as table data.
-    for (line in report.processes) {
-        rows_html += "<tr>";
-        for (column in ordered_keys) {
-            rows_html += "<td>" + report.processes[line][ordered_keys[column]] + "</td>";
+    get_processes();
 
+    // Sort by a clicked column. Clicking the sorted column again reverses the order.
+    $('#processes_table th[data-sort]').click(function() {
+        var sort = $(this).attr('data-sort');
+        if (process_page.sort == sort) {
+            process_page.order = process_page.order == 'desc' ? 'asc' : 'desc';
+        } else {
+            process_page.sort = sort;
+            process_page.order = ['user', 'state', 'cmd'].indexOf(sort) == -1 ? 'desc' : 'asc';
         }
+        process_page.offset = 0;
+        get_processes();
+    });
 
-        // Add action buttons viewable by admins only, then end the row. Buttons are identifiable by pid.
-        rows_html += "<td class='admin'>" +
-            "<button id='hang-pid-" + report.processes[line]['pid'] + "' class='btn btn-default process-btn'>Hang Up (soft)</button>" +
-            "<button id='kill-pid-" + report.processes[line]['pid'] + "' class='btn btn-default process-btn'>Kill (hard)</button>" +
-        "</td>";
-        rows_html += "</tr>";
-    }
+    // Filter by pid, user, or command.
+    $('#process_filter_form').submit(function(event) {
+        event.preventDefault();
+        process_page.q = $('#process_filter_form input[name=q]').val();
+        process_page.offset = 0;
+        get_processes();
+    });
 
-    // Add new html to the table.
-    $('#processes_table').append(rows_html);
+    // Page through processes.
+    $('#processes_prev_btn').click(function() {
+        process_page.offset = Math.max(0, process_page.offset - process_page_size);
+        get_processes();
+    });
+    $('#processes_next_btn').click(function() {
+        process_page.offset += process_page_size;
+        get_processes();
+    });
 
     // Handler for process buttons. Handling will be blocked at server if not an admin.
-    $('.process-btn').click(function() {
+    $('#processes_table').on('click', '.process-btn', function() {
         $.ajax({
             type: 'POST',
             url: 'command',
@@ -537,14 +557,62 @@ function processes() {
                 pid: $(this).attr('id').substring(9)
             },
             success: function(data) {
-                // Notify results and get new report.
+                // Notify results and list processes again.
                 alert(data.details);
-                getReport();
+                get_processes(true);
             }
         });
     });
 }
 
+/*
+    Pull the page of processes described by process_page from the server and display it.
+    Pages come from the server's last listing of processes while it is recent. Pass refresh as true to list them again.
+*/
+function get_processes(refresh) {
+    $.ajax({
+        type: 'GET',
+        url: 'processes',
+        data: {
+            'action': 'get_processes',
+            'sort': process_page.sort,
+            'order': process_page.order,
+            'q': process_page.q,
+            'offset': process_page.offset,
+            'limit': process_page_size,
+            'refresh': refresh ? 1 : 0
+        },
+        success: function(data) {
+            // Ensure processes were returned.
+            if (typeof data.return != 'object') {
+                alert(data.return);
+                return;
+            }
+
+            // Replace previous rows with a row per process. Action buttons are identifiable by pid.
+            $('#processes_table tr').slice(1).remove();
+            data.return.processes.forEach(function(process) {
+                var row = $('<tr>');
+                ['pid', 'user', 'ppid', 'state', 'cpu', 'rss', 'time', 'cmd'].forEach(function(field) {
+                    row.append($('<td>').text(process[field]));
+                });
+                row.append($("<td class='admin'>").toggle(admin == 1).html(
+                    "<button id='hang-pid-" + process.pid + "' class='btn btn-default process-btn'>Hang Up (soft)</button>" +
+                    "<button id='kill-pid-" + process.pid + "' class='btn btn-default process-btn'>Kill (hard)</button>"
+                ));
+                $('#processes_table').append(row);
+            });
+
+            // Show which processes are listed and whether there are more either side.
+            process_page.offset = data.return.offset;
+            var last = process_page.offset + data.return.processes.length;
+            $('#processes_count').text((last ? process_page.offset + 1 : 0) + '-' + last + ' of ' + data.return.total);
+            $('#processes_prev_btn').prop('disabled', process_page.offset == 0);
+            $('#processes_next_btn').prop('disabled', last >= data.return.total);
+        }
+    });
+}
+
 /*
     Logs page route.
 */
@@ -561,6 +629,17 @@ function logs() {
         $('#lognames_btn').click(function() {
             get_logs($('#lognames').val());
         });
+
+        // Listen for requests to see earlier lines of the displayed log.
+        $('#older_logs_btn').click(function() {
+            get_logs(log_page.logname, true);
+        });
+
+        // Listen for log searches.
+        $('#log_search_form').submit(function(event) {
+            event.preventDefault();
+            search_logs();
+        });
     }
 }
 
@@ -889,26 +968,44 @@ function settings() {
 }
 
 /*
-    Request user logs from the server and display them on the page.
+    Request a page of user logs from the server and display it on the page.
+    The latest lines of logname are shown. Pass older as true to add the page before the lines already shown instead.
     Server will block requests from non-admins.
 */
-function get_logs(logname) {
+function get_logs(logname, older) {
+    var request = {
+        'action': 'get_whm_logs',
+        'logname': logname
+    };
+    if (older) {
+        // Nothing is before the first line.
+        if (log_page.offset == 0) {
+            return;
+        }
+        request.offset = Math.max(0, log_page.offset - log_page_lines);
+        request.limit = log_page.offset - request.offset;
+    } else {
+        request.tail = log_page_lines;
+    }
+
     $.ajax({
         type: 'GET',
         url: 'logs',
-        data: {
-            'action': 'get_whm_logs',
-            'logname': logname
-        },
+        data: request,
         success: function(data) {
             // Ensure propper return of logs.
             if (data.return == 'Failed to read logs...') {
                 alert(data.return);
+                return;
             }
 
-            // Display log data, and scroll to the latest evets.
-            $('#whm_logs pre samp').html(data.return.log_text);
-            $('#whm_logs pre').scrollTop($('#whm_logs pre')[0].scrollHeight);
+            // Display log data. Scroll to the latest events, or to the top of earlier lines that were added.
+            log_page.text = older ? data.return.log_text + log_page.text : data.return.log_text;
+            log_page.offset = data.return.offset;
+            log_page.logname = logname;
+            $('#whm_logs pre samp').text(log_page.text);
+            $('#whm_logs pre').scrollTop(older ? 0 : $('#whm_logs pre')[0].scrollHeight);
+            $('#older_logs_btn').prop('disabled', log_page.offset == 0);
 
             // Load available archived logs as select options.
             var log_files_html = "";
@@ -924,11 +1021,52 @@ function get_logs(logname) {
     });
 }
 
+/*
+    Search user logs with the fields of the log search form and list matching lines, newest first.
+    Server will block requests from non-admins.
+*/
+function search_logs() {
+    var request = {
+        'action': 'search_whm_logs'
+    };
+    $('#log_search_form').serializeArray().forEach(function(field) {
+        request[field.name] = field.value;
+    });
+
+    $.ajax({
+        type: 'GET',
+        url: 'logs',
+        data: request,
+        success: function(data) {
+            // Ensure results were returned.
+            if (!Array.isArray(data.return)) {
+                alert(data.return);
+                return;
+            }
+
+            // Replace previous results with a row per matching line.
+            $('#log_search_table tr').slice(1).remove();
+            data.return.forEach(function(result) {
+                var row = $('<tr>');
+                ['time', 'source', 'user', 'event'].forEach(function(field) {
+                    row.append($('<td>').text(result[field]));
+                });
+                row.append($('<td>').text(result.logname + ':' + (result.line + 1)));
+                $('#log_search_table').append(row);
+            });
+            if (data.return.length == 0) {
+                $('#log_search_table').append($('<tr>').append($('<td colspan="5">').text('No matching lines.')));
+            }
+        }
+    });
+}
+
 /*
     Pull current metrics from the server.
     Store the data in session storage and refresh the page.
+    Pass force as true to ask for a newly collected report (admins only).
 */
-function getReport() {
+function getReport(force) {
     // Limit interface while report is loading.
     $('.navbar-right').html('');
     $('.navbar-left').html('');
@@ -944,6 +1082,7 @@ function getReport() {
     $.ajax({
         type: 'GET',
         url: 'getReport',
+        data: force ? {force: 1} : {},
         success: function(data) {
             sessionStorage.setItem("report", JSON.stringify(data["report"]));
             location.reload();
@@ -1105,117 +1244,203 @@ function table_and_chart(prefix, title, data, headers, current_labels, default_u
         data: []
     };
 
-    // Get key_order from DB.
-    $.ajax({
-        type: 'POST',
-        url: 'chart_data',
-        data: {
-            data_set: prefix,
-            scale: 'hours',
-            data_needed: 'keys'
-        },
-        success: function(db_data) {
+    // Keys and hours history are loaded with the page's other charts in one request. See load_charts().
+    if (pending_charts.length == 0) {
+        setTimeout(load_charts, 0);
+    }
+    pending_charts.push({
+        data_set: prefix,
+        setup: setup
+    });
+
+    // Initialize a new chart var.
+    var chart;
 
-            var key_order = db_data.keys;
+    // History already pulled for each scope, as {time: [ms], columns: {key: [values]}, cursor: epoch seconds to poll from}.
+    var scope_history = {};
 
-            // If current_labels is null, it is set to key_order.
-            if (current_labels == null) {
-                current_labels = key_order;
+    // Key order from DB.
+    var key_order = [];
+
+    // Takes this chart's result from chart_batch and builds the current data table, chart, and historic chart.
+    function setup(db_data) {
+        key_order = db_data.keys;
+
+        // If current_labels is null, it is set to key_order.
+        if (current_labels == null) {
+            current_labels = key_order;
+        }
+
+        // For each key provided:
+        for (var i = 0; i < key_order.length; i++) {
+            // Add this key, value to current metrics table.
+            $("#" + prefix + "_current_table").append("<tr><td>" + key_order[i] + "</td><td>" + data[key_order[i]] + "</td></tr>");
+
+            // Add checkbox for this key on historic data chart control.
+            var checkbox_html = "<div><input type='checkbox' name='" + key_order[i] + "' id='" + key_order[i] + "' ";
+            if (!default_unchecked.includes(key_order[i])) {
+                checkbox_html += "checked ";
+            }
+            checkbox_html += "/><label>" + key_order[i] + "</label></div>";
+            $('#' + prefix + '_chart_form').append(checkbox_html);
+
+            // Add data to current data so it can be accepted by draw(). See the difference between how this
+            // function accepts data and draw() accepts data.
+            if (current_labels.includes(key_order[i])){
+                processed_current_data.labels.push(key_order[i]);
+                processed_current_data.data.push(data[key_order[i]]);
             }
+        }
 
-            // For each key provided:
-            for (var i = 0; i < key_order.length; i++) {
-                // Add this key, value to current metrics table.
-                $("#" + prefix + "_current_table").append("<tr><td>" + key_order[i] + "</td><td>" + data[key_order[i]] + "</td></tr>");
+        // Draw current metrics chart.
+        draw(prefix + '_current_chart', current_type, processed_current_data, 'labels', null);
 
-                // Add checkbox for this key on historic data chart control.
-                var checkbox_html = "<div><input type='checkbox' name='" + key_order[i] + "' id='" + key_order[i] + "' ";
-                if (!default_unchecked.includes(key_order[i])) {
-                    checkbox_html += "checked ";
+        // Show the hours history that came with the batch.
+        if (db_data.success) {
+            merge_history('hours', db_data);
+        }
+        show_history('hours');
+
+        // Anytime scope is changed. This refers to Hours, Days, and Weeks.
+        $('#' + prefix + '_chart_scope').change(function() {
+            load_history(this.value);
+        });
+
+        // Check for new data at the selected scope every few minutes.
+        setInterval(function() {
+            load_history($('#' + prefix + '_chart_scope').val());
+        }, 300000);
+    }
+
+    // Get historical data for this device/prefix at the specified scale. Only rows newer than those held are pulled.
+    function load_history(scope) {
+        $.ajax({
+            type: 'POST',
+            url: 'chart_data',
+            data: {
+                data_set: prefix,
+                scale: scope,
+                data_needed: 'history',
+                since: scope in scope_history ? scope_history[scope].cursor : 0,
+                max_points: 400,
+                format: 'columnar'
+            },
+            success: function(db_data) {
+                // Add new data to held history.
+                if (db_data.success) {
+                    merge_history(scope, db_data);
                 }
-                checkbox_html += "/><label>" + key_order[i] + "</label></div>";
-                $('#' + prefix + '_chart_form').append(checkbox_html);
-
-                // Add data to current data so it can be accepted by draw(). See the difference between how this
-                // function accepts data and draw() accepts data.
-                if (current_labels.includes(key_order[i])){
-                    processed_current_data.labels.push(key_order[i]);
-                    processed_current_data.data.push(data[key_order[i]]);
+                show_history(scope);
+            }
+        });
+    }
+
+    // Draw held history for scope.
+    function show_history(scope) {
+        // Reset chart form listener. Will be added back later if applicable.
+        $('#' + prefix + '_chart_form').off('change');
+
+        // If no data is held, show no data message.
+        if (!(scope in scope_history) || scope_history[scope].time.length == 0) {
+            $('#' + prefix + '_history_chart').hide();
+            $('#' + prefix + '_no_chart').show();
+            return;
+        }
+        var held = scope_history[scope];
+
+        // Data is held. Set elements for data display.
+        $('#' + prefix + '_history_chart').show();
+        $('#' + prefix + '_no_chart').hide();
+
+        // When labels are checked/unchecked:
+        $('#' + prefix + '_chart_form').change(function() {
+            // Chart time and each checked key/field. Held columns are already in the form draw() accepts.
+            var processed_data = {
+                time: held.time
+            };
+            for (var i = 0; i < key_order.length; i++) {
+                if ($('#' + prefix + '_chart_form input#' + key_order[i]).is(':checked')){
+                    processed_data[key_order[i]] = held.columns[key_order[i]];
                 }
             }
 
-            // Draw current metrics chart.
-            draw(prefix + '_current_chart', current_type, processed_current_data, 'labels', null);
-
-            // Initialize a new chart var.
-            var chart;
-
-            // Anytime scope is changed. This refers to Hours, Days, and Weeks.
-            $('#' + prefix + '_chart_scope').change(function() {
-
-                // Reset chart form listener. Will be added back later if applicable.
-                $('#' + prefix + '_chart_form').off('change');
-
-                // Get historical data for this device/prefix at the specified scale.
-                $.ajax({
-                    type: 'POST',
-                    url: 'chart_data',
-                    data: {
-                        data_set: prefix,
-                        scale: this.value,
-                        data_needed: 'history'
-                    },
-                    success: function(db_data) {
-                        // If no data was returned, show no data message.
-                        if (!db_data.success || db_data.data.length == 0) {
-                            $('#' + prefix + '_history_chart').hide();
-                            $('#' + prefix + '_no_chart').show();
-                            return;
-                        }
+            // Draw historical metrics chart.
+            chart = draw(prefix + '_history_chart', 'line', processed_data, 'time', chart);
+        });
 
-                        // Data returned. Set elements for data display.
-                        $('#' + prefix + '_history_chart').show();
-                        $('#' + prefix + '_no_chart').hide();
-
-                        // When labels are checked/unchecked:
-                        $('#' + prefix + '_chart_form').change(function() {
-                            // Initialize historical data to process data into.
-                            var processed_data = {
-                                time: []
-                            };
-
-                            // Initialize a cache of keys/fields and their index in db_data.data.
-                            var index_of_cache = {
-                                time: 0
-                            };
-
-                            // For keys/fields that are checked, initialize their array in proccessed data and cache their db index.
-                            for (var i = 0; i < key_order.length; i++) {
-                                if ($('#' + prefix + '_chart_form input#' + key_order[i]).is(':checked')){
-                                    processed_data[key_order[i]] = [];
-                                    index_of_cache[key_order[i]] = i + 1;
-                                }
-                            }
+        // Run field/key change handler to set up chart.
+        $('#' + prefix + '_chart_form').trigger('change');
+    }
 
-                            // Convert db_data to processed_data.
-                            for (var i = 0; i < db_data.data.length; i++) {
-                                for (key in processed_data) {
-                                    processed_data[key].push(db_data.data[i][index_of_cache[key]]);
-                                }
-                            }
+    // Add a columnar chart_data response to held history for scope. The server resends the newest held point
+    // as its bucket may have changed, so held points at or after the first new time are replaced.
+    function merge_history(scope, db_data) {
+        if (!(scope in scope_history)) {
+            scope_history[scope] = {
+                time: [],
+                columns: {},
+                cursor: 0
+            };
+        }
+        var held = scope_history[scope];
+
+        // Rebuild times from the start value and deltas, in ms for charting.
+        var times = [];
+        var t = db_data.data.time_start;
+        for (var i = 0; i < db_data.data.time_deltas.length; i++) {
+            t += db_data.data.time_deltas[i];
+            times.push(t * 1000);
+        }
 
-                            // Draw historical metrics chart.
-                            chart = draw(prefix + '_history_chart', 'line', processed_data, 'time', chart);
-                        });
+        if (times.length > 0) {
+            var keep = held.time.length;
+            while (keep > 0 && held.time[keep - 1] >= times[0]) {
+                keep--;
+            }
+            held.time = held.time.slice(0, keep).concat(times);
+            for (var key in db_data.data.columns) {
+                // A key first seen in this response has no held values.
+                if (!(key in held.columns)) {
+                    held.columns[key] = new Array(keep).fill(null);
+                }
+                held.columns[key] = held.columns[key].slice(0, keep).concat(db_data.data.columns[key]);
+            }
+        }
+        held.cursor = db_data.cursor;
+    }
+}
 
-                        // Run field/key change handler to set up chart on ajax return.
-                        $('#' + prefix + '_chart_form').trigger('change');
-                    }
-                });
-            });
+/*
+    Sends one chart_batch request for every chart in pending_charts and passes each chart its result.
+    table_and_chart() schedules this, so all charts drawn while a page loads share one request.
+*/
+function load_charts() {
+    var charts = pending_charts;
+    pending_charts = [];
 
-            // Run scope change handler to pull ajax on page load.
-            $('#' + prefix + '_chart_scope').trigger('change');
+    $.ajax({
+        type: 'POST',
+        url: 'chart_batch',
+        data: {
+            charts: JSON.stringify(charts.map(function(chart) {
+                return {
+                    data_set: chart.data_set,
+                    scale: 'hours'
+                };
+            })),
+            max_points: 400
+        },
+        success: function(batch) {
+            for (var i = 0; i < charts.length; i++) {
+                if (batch.success) {
+                    charts[i].setup(batch.charts[i]);
+                } else {
+                    charts[i].setup({
+                        success: false,
+                        keys: []
+                    });
+                }
+            }
         }
     });
 }